@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # MBZ-XML-TO-EXCEL benchmark
+#
+# Times MBZ_Extractor_Config.extract() on synthetic Moodle backups, so changes can be measured without sharing real course data.
+# The generated mbz has the usual layout (moodle_backup.xml, users.xml, course/, sections/section_N/, activities/forum_N/,
+# activities/quiz_N/ and logstores.xml files) with fake students, forum posts, quiz attempts and log rows.
+#
+# Each phase of extract() is timed separately. Peak memory (ru_maxrss) is recorded after each phase;
+# every run is done in a fresh process so the peaks of different runs do not mix.
+#
+# Example use:
+'''
+python mbz_benchmark.py generate bench.mbz --students 400 --log-rows 200000
+python mbz_benchmark.py run --students 400 --log-rows 200000 --repeat 3 --results before.json
+python mbz_benchmark.py run --students 400 --log-rows 200000 --repeat 3 --results after.json --set aggregate_in_memory=true --set workers=4
+python mbz_benchmark.py compare before.json after.json
+'''
+
+import argparse
+import base64
+import concurrent.futures
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import time
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+
+import mbz_reader
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+# Phase name -> MBZ_Extractor_Config method, in the order extract() calls them
+BENCHMARK_PHASES = OrderedDict([
+    ('load_anonid_data', 'load_anonid_data'),
+    ('load_geoip_data', 'load_geoip_data'),
+    ('expand', 'lazy_extract_mbz'),
+    ('process_xml_files', 'process_xml_files'),
+    ('aggregate_over_sections', 'aggreate_over_sections'),
+    ('aggregate_over_common_objects', 'aggreate_over_common_objects'),
+    ('aggregate_in_memory', 'aggregate_in_memory_workbooks'),
+    ('column_metalist', 'create_column_metalist'),
+])
+
+BENCHMARK_SIZE_DEFAULTS = OrderedDict([
+    ('students', 100),
+    ('sections', 8),
+    ('log_rows', 20000), # course/logstores.xml; each activity also gets log_rows / (4 * sections) rows
+    ('forum_posts', 50), # per forum (one forum per section)
+    ('quiz_attempts', 100), # per quiz (one quiz per section)
+    ('seed', 1),
+])
+
+FIRST_USERID = 100
+FIRST_TIMESTAMP = 1546300800 # 2019-01-01
+
+
+# # Synthetic backup
+
+def php_serialize(values):
+    out = 'a:%d:{' % len(values)
+    for key, value in values.items():
+        out += 's:%d:"%s";' % (len(key), key)
+        if isinstance(value, int):
+            out += 'i:%d;' % value
+        else:
+            out += 's:%d:"%s";' % (len(value.encode('utf-8')), value)
+    return out + '}'
+
+def xml_document(body):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + body
+
+def random_ip(rnd):
+    return '%d.%d.%d.%d' % (rnd.randrange(1, 224), rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+
+def html_paragraphs(rnd, words, count):
+    return ''.join('<p>' + ' '.join(rnd.choice(words) for _ in range(rnd.randrange(4, 20))) + '</p>' for _ in range(count))
+
+WORDS = ['the', 'answer', 'question', 'week', 'lecture', 'because', 'data', 'think', 'example', 'with', '<b>important</b>', 'I', 'agree', 'graph', 'model', '&amp;']
+
+def generate_users_xml(rnd, students):
+    rows = ['<users>']
+    for i in range(students):
+        userid = FIRST_USERID + i
+        rows.append('<user id="%d" contextid="%d"><username>student%d</username><idnumber></idnumber><email>student%d@example.edu</email>'
+            '<firstname>First%d</firstname><lastname>Last%d</lastname><city>$@NULL@$</city><country>US</country><lang>en</lang>'
+            '<description>%s</description><firstaccess>%d</firstaccess><lastaccess>%d</lastaccess><lastlogin>%d</lastlogin><currentlogin>%d</currentlogin>'
+            '<lastip>%s</lastip><timecreated>%d</timecreated><timemodified>%d</timemodified>'
+            '<custom_fields></custom_fields><tags></tags><preferences><preference><name>email_bounce_count</name><value>1</value></preference></preferences>'
+            '<roles><role_overrides></role_overrides><role_assignments></role_assignments></roles></user>' % (
+            userid, 1000 + i, userid, userid, i, i, escape(html_paragraphs(rnd, WORDS, 1)) if i % 3 else '$@NULL@$',
+            FIRST_TIMESTAMP + i * 60, FIRST_TIMESTAMP + 86400 * 90 + i, FIRST_TIMESTAMP + 86400 * 89, FIRST_TIMESTAMP + 86400 * 90,
+            random_ip(rnd) if i % 7 else '', FIRST_TIMESTAMP - 86400, FIRST_TIMESTAMP))
+    rows.append('</users>')
+    return xml_document('\n'.join(rows))
+
+LOG_EVENTS = [
+    ('\\core\\event\\course_viewed', 'core', 'viewed', 'course', '$@NULL@$', 'r'),
+    ('\\mod_forum\\event\\discussion_viewed', 'mod_forum', 'viewed', 'discussion', 'forum_discussions', 'r'),
+    ('\\mod_forum\\event\\post_created', 'mod_forum', 'created', 'post', 'forum_posts', 'c'),
+    ('\\mod_quiz\\event\\attempt_started', 'mod_quiz', 'started', 'attempt', 'quiz_attempts', 'c'),
+    ('\\mod_quiz\\event\\attempt_submitted', 'mod_quiz', 'submitted', 'attempt', 'quiz_attempts', 'u'),
+]
+
+def generate_logstores_xml(rnd, students, rows, first_id, contextinstanceid):
+    lines = ['<logstores><logstore><subplugin_logstore_standard_log><logstore_standard_log_records>']
+    timestamp = FIRST_TIMESTAMP
+    for i in range(rows):
+        eventname, component, action, target, objecttable, crud = rnd.choice(LOG_EVENTS)
+        timestamp += rnd.randrange(0, 120)
+        if objecttable == '$@NULL@$':
+            other = '$@NULL@$'
+        else:
+            other = base64.b64encode(php_serialize(OrderedDict([('instanceid', contextinstanceid), ('objectid', i), ('mode', 'view')])).encode('utf-8')).decode('ascii')
+        lines.append('<logstore_standard_log id="%d"><eventname>%s</eventname><component>%s</component><action>%s</action><target>%s</target>'
+            '<objecttable>%s</objecttable><objectid>%s</objectid><crud>%s</crud><edulevel>2</edulevel><contextid>%d</contextid><contextlevel>70</contextlevel>'
+            '<contextinstanceid>%d</contextinstanceid><userid>%d</userid><courseid>2</courseid><relateduserid>$@NULL@$</relateduserid><anonymous>0</anonymous>'
+            '<other>%s</other><timecreated>%d</timecreated><origin>web</origin><ip>%s</ip><realuserid>$@NULL@$</realuserid></logstore_standard_log>' % (
+            first_id + i, escape(eventname), component, action, target, objecttable, '$@NULL@$' if objecttable == '$@NULL@$' else str(rnd.randrange(1, 5000)),
+            crud, 100 + contextinstanceid, contextinstanceid, FIRST_USERID + rnd.randrange(students), other, timestamp, random_ip(rnd)))
+    lines.append('</logstore_standard_log_records></subplugin_logstore_standard_log></logstore></logstores>')
+    return xml_document('\n'.join(lines))
+
+def generate_forum_xml(rnd, students, forumid, posts):
+    parts = ['<activity id="%d" moduleid="%d" modulename="forum" contextid="%d"><forum id="%d"><type>general</type><name>Forum %d</name>'
+        '<intro>%s</intro><introformat>1</introformat><timemodified>%d</timemodified><discussions>' % (
+        forumid, forumid, 100 + forumid, forumid, forumid, escape(html_paragraphs(rnd, WORDS, 2)), FIRST_TIMESTAMP)]
+    postid = forumid * 100000
+    remaining = posts
+    discussion = 0
+    while remaining > 0:
+        discussion += 1
+        in_discussion = min(remaining, rnd.randrange(1, 20))
+        remaining -= in_discussion
+        first_post = postid + 1
+        parts.append('<discussion id="%d"><name>Discussion %d</name><firstpost>%d</firstpost><userid>%d</userid><groupid>-1</groupid>'
+            '<timemodified>%d</timemodified><usermodified>%d</usermodified><posts>' % (
+            forumid * 1000 + discussion, discussion, first_post, FIRST_USERID + rnd.randrange(students), FIRST_TIMESTAMP, FIRST_USERID))
+        for i in range(in_discussion):
+            postid += 1
+            created = FIRST_TIMESTAMP + rnd.randrange(86400 * 90)
+            parts.append('<post id="%d"><parent>%d</parent><userid>%d</userid><created>%d</created><modified>%d</modified><mailed>1</mailed>'
+                '<subject>Re: Discussion %d</subject><message>%s</message><messageformat>1</messageformat><messagetrust>0</messagetrust>'
+                '<attachment></attachment><totalscore>0</totalscore><mailnow>0</mailnow><ratings></ratings></post>' % (
+                postid, 0 if i == 0 else first_post, FIRST_USERID + rnd.randrange(students), created, created, discussion,
+                escape(html_paragraphs(rnd, WORDS, rnd.randrange(1, 4)))))
+        parts.append('</posts><discussion_subs></discussion_subs></discussion>')
+    parts.append('</discussions><subscriptions></subscriptions><digests></digests><readposts></readposts><trackedprefs></trackedprefs></forum></activity>')
+    return xml_document(''.join(parts))
+
+def generate_quiz_xml(rnd, students, quizid, attempts):
+    parts = ['<activity id="%d" moduleid="%d" modulename="quiz" contextid="%d"><quiz id="%d"><name>Quiz %d</name><intro>%s</intro>'
+        '<timeopen>0</timeopen><timeclose>0</timeclose><timelimit>0</timelimit><grade>10.00000</grade><sumgrades>3.00000</sumgrades>'
+        '<question_instances><question_instance id="%d"><slot>1</slot><questionid>1</questionid><maxmark>1.0000000</maxmark></question_instance></question_instances>'
+        '<grades></grades><attempts>' % (quizid, quizid, 100 + quizid, quizid, quizid, escape(html_paragraphs(rnd, WORDS, 1)), quizid)]
+    for i in range(attempts):
+        attemptid = quizid * 100000 + i
+        start = FIRST_TIMESTAMP + rnd.randrange(86400 * 90)
+        steps = []
+        for s in range(3):
+            steps.append('<step id="%d"><sequencenumber>%d</sequencenumber><state>%s</state><fraction>$@NULL@$</fraction><timecreated>%d</timecreated><userid>%d</userid>'
+                '<response><variable><name>answer</name><value>%d</value></variable></response></step>' % (
+                attemptid * 10 + s, s, ['todo', 'complete', 'gradedright'][s], start + s * 60, FIRST_USERID + i % students, rnd.randrange(4)))
+        parts.append('<attempt id="%d"><userid>%d</userid><attemptnum>1</attemptnum><uniqueid>%d</uniqueid><layout>1,0</layout><currentpage>0</currentpage>'
+            '<preview>0</preview><state>finished</state><timestart>%d</timestart><timefinish>%d</timefinish><timemodified>%d</timemodified><sumgrades>%d.0000000</sumgrades>'
+            '<question_usage id="%d"><component>mod_quiz</component><preferredbehaviour>deferredfeedback</preferredbehaviour><question_attempts>'
+            '<question_attempt id="%d"><slot>1</slot><behaviour>deferredfeedback</behaviour><questionid>1</questionid><maxmark>1.0000000</maxmark>'
+            '<questionsummary>%s</questionsummary><rightanswer>A</rightanswer><responsesummary>B</responsesummary><timemodified>%d</timemodified>'
+            '<steps>%s</steps></question_attempt></question_attempts></question_usage></attempt>' % (
+            attemptid, FIRST_USERID + i % students, attemptid, start, start + 600, start + 600, rnd.randrange(4), attemptid, attemptid,
+            escape(' '.join(rnd.choice(WORDS) for _ in range(8))), start + 600, ''.join(steps)))
+    parts.append('</attempts><overrides></overrides></quiz></activity>')
+    return xml_document(''.join(parts))
+
+def generate_mbz_files(students, sections, log_rows, forum_posts, quiz_attempts, seed):
+    rnd = random.Random(seed)
+    files = OrderedDict()
+    activities = []
+    for section in range(1, sections + 1):
+        activities.append(('forum', 2 * section, section))
+        activities.append(('quiz', 2 * section + 1, section))
+
+    files['moodle_backup.xml'] = xml_document('<moodle_backup><information><name>benchmark.mbz</name><moodle_version>2018120300</moodle_version>'
+        '<backup_date>%d</backup_date><original_course_id>2</original_course_id><original_course_startdate>%d</original_course_startdate>'
+        '<original_course_enddate>0</original_course_enddate><contents><activities>%s</activities><sections>%s</sections></contents>'
+        '<settings><setting><level>root</level><name>users</name><value>1</value></setting><setting><level>root</level><name>logs</name><value>1</value></setting></settings>'
+        '</information></moodle_backup>' % (
+        FIRST_TIMESTAMP + 86400 * 100, FIRST_TIMESTAMP,
+        ''.join('<activity><moduleid>%d</moduleid><sectionid>%d</sectionid><modulename>%s</modulename><title>%s %d</title><directory>activities/%s_%d</directory></activity>' % (
+            moduleid, section, modulename, modulename, moduleid, modulename, moduleid) for modulename, moduleid, section in activities),
+        ''.join('<section><sectionid>%d</sectionid><title>%d</title><directory>sections/section_%d</directory></section>' % (s, s, s) for s in range(1, sections + 1))))
+    files['users.xml'] = generate_users_xml(rnd, students)
+    files['groups.xml'] = xml_document('<groups><groupings></groupings></groups>')
+    files['questions.xml'] = xml_document('<question_categories><question_category id="1"><name>Default</name><info>%s</info><questions>'
+        '<question id="1"><name>Q1</name><questiontext>%s</questiontext><qtype>multichoice</qtype><timecreated>%d</timecreated><timemodified>%d</timemodified>'
+        '<plugin_qtype_multichoice_question><answers>%s</answers></plugin_qtype_multichoice_question></question></questions></question_category></question_categories>' % (
+        escape('<p>Default category</p>'), escape(html_paragraphs(rnd, WORDS, 1)), FIRST_TIMESTAMP, FIRST_TIMESTAMP,
+        ''.join('<answer id="%d"><answertext>%s</answertext><fraction>%s</fraction><feedback></feedback></answer>' % (a, escape('<p>%s</p>' % 'ABCD'[a]), '1.0000000' if a == 0 else '0.0000000') for a in range(4))))
+    files['course/course.xml'] = xml_document('<course id="2" contextid="20"><shortname>BENCH</shortname><fullname>Benchmark course</fullname>'
+        '<summary>%s</summary><format>topics</format><startdate>%d</startdate><timecreated>%d</timecreated><timemodified>%d</timemodified><tags></tags></course>' % (
+        escape(html_paragraphs(rnd, WORDS, 2)), FIRST_TIMESTAMP, FIRST_TIMESTAMP, FIRST_TIMESTAMP))
+    files['course/logstores.xml'] = generate_logstores_xml(rnd, students, log_rows, 1, 2)
+
+    activity_log_rows = log_rows // (4 * max(sections, 1))
+    for section in range(1, sections + 1):
+        directory = 'sections/section_%d/' % section
+        files[directory + 'section.xml'] = xml_document('<section id="%d"><number>%d</number><name>$@NULL@$</name><summary>%s</summary>'
+            '<summaryformat>1</summaryformat><sequence>%d,%d</sequence><visible>1</visible><timemodified>%d</timemodified></section>' % (
+            section, section, escape(html_paragraphs(rnd, WORDS, 1)), 2 * section, 2 * section + 1, FIRST_TIMESTAMP))
+        files[directory + 'inforef.xml'] = xml_document('<inforef></inforef>')
+
+    for modulename, moduleid, section in activities:
+        directory = 'activities/%s_%d/' % (modulename, moduleid)
+        if modulename == 'forum':
+            files[directory + 'forum.xml'] = generate_forum_xml(rnd, students, moduleid, forum_posts)
+        else:
+            files[directory + 'quiz.xml'] = generate_quiz_xml(rnd, students, moduleid, quiz_attempts)
+        files[directory + 'grades.xml'] = xml_document('<activity_gradebook><grade_items><grade_item id="%d"><itemname>%s %d</itemname><grade_grades>%s</grade_grades></grade_item></grade_items></activity_gradebook>' % (
+            moduleid, modulename, moduleid, ''.join('<grade_grade id="%d"><userid>%d</userid><rawgrade>%d.00000</rawgrade><feedback>$@NULL@$</feedback><timecreated>%d</timecreated></grade_grade>' % (
+                moduleid * 100000 + i, FIRST_USERID + i, rnd.randrange(101), FIRST_TIMESTAMP) for i in range(students))))
+        files[directory + 'logstores.xml'] = generate_logstores_xml(rnd, students, activity_log_rows, 1 + log_rows + moduleid * activity_log_rows, moduleid)
+        files[directory + 'inforef.xml'] = xml_document('<inforef></inforef>')
+    return files
+
+# Writes a synthetic mbz (gzipped tar, like Moodle's own backups) and returns its filename
+def generate_mbz(mbz_filename, students = 100, sections = 8, log_rows = 20000, forum_posts = 50, quiz_attempts = 100, seed = 1):
+    files = generate_mbz_files(students, sections, log_rows, forum_posts, quiz_attempts, seed)
+    output_dir = os.path.dirname(os.path.abspath(mbz_filename))
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    with tarfile.open(mbz_filename, 'w:gz') as tar:
+        for name, content in files.items():
+            data = content.encode('utf-8')
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = FIRST_TIMESTAMP
+            tar.addfile(info, io.BytesIO(data))
+    return mbz_filename
+
+# Writes a small IP2Location style csv so the geoip decoding is part of the benchmark
+def generate_geoip_csv(geoip_dir, ranges = 5000):
+    if not os.path.isdir(geoip_dir):
+        os.makedirs(geoip_dir)
+    step = 2**32 // ranges
+    with open(os.path.join(geoip_dir, 'IP2LOCATION-LITE-DB11.CSV'), 'w') as f:
+        for i in range(ranges):
+            ipfrom = i * step
+            ipto = 2**32 - 1 if i == ranges - 1 else ipfrom + step - 1
+            f.write('"%d","%d","C%d","Country %d","Region %d","City %d","%f","%f","%05d","-0%d:00"\n' % (
+                ipfrom, ipto, i % 50, i % 50, i % 500, i, -60 + 120. * i / ranges, -180 + 360. * i / ranges, i, i % 9))
+    return geoip_dir
+
+
+# # Running the benchmark
+
+def max_rss_mb(who):
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(maxrss / (1024. * 1024. if sys.platform == 'darwin' else 1024.), 1)
+
+def directory_size(directory):
+    total = 0
+    files = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+            files += 1
+    return files, total
+
+# MBZ_Extractor_Config with the phase methods timed into self.benchmark_phases.
+# A subclass (rather than wrapping the methods of one instance) so the configuration can still be pickled for the worker processes
+class TimedExtractorConfig(mbz_reader.MBZ_Extractor_Config):
+    def __init__(self):
+        super().__init__()
+        self.benchmark_phases = OrderedDict()
+
+def timed_phase(phase, method):
+    def run(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.benchmark_phases[phase] = OrderedDict([
+                ('seconds', round(time.perf_counter() - start, 3)),
+                ('max_rss_mb', max_rss_mb(resource.RUSAGE_SELF) if resource else None),
+                ('max_worker_rss_mb', max_rss_mb(resource.RUSAGE_CHILDREN) if resource else None)])
+    return run
+
+# Phases whose method is not in this version of mbz_reader (e.g. an older revision that is being compared); reported as absent
+ABSENT_PHASES = [phase for phase, method_name in BENCHMARK_PHASES.items() if not hasattr(mbz_reader.MBZ_Extractor_Config, method_name)]
+
+for phase, method_name in BENCHMARK_PHASES.items():
+    if phase not in ABSENT_PHASES:
+        setattr(TimedExtractorConfig, method_name, timed_phase(phase, getattr(mbz_reader.MBZ_Extractor_Config, method_name)))
+
+# One extract() of mbz_filename into work_dir. Run in a fresh process (see run_benchmark)
+def benchmark_once(mbz_filename, work_dir, options, geoip_dir):
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    xml_dir = os.path.join(work_dir, 'xml')
+    output_dir = os.path.join(work_dir, 'out')
+    for directory in [xml_dir, output_dir]:
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+
+    config = TimedExtractorConfig()
+    config.archive_source_file = mbz_filename
+    config.expanded_archive_directory = xml_dir
+    config.output_directory = output_dir
+    config.generate_missing_anonid = 'salt+sha1'
+    config.salt = 'benchmark-salt-'
+    config.geoip_datadir = geoip_dir
+    for name, value in options.items():
+        if not hasattr(config, name):
+            raise ValueError('Unknown MBZ_Extractor_Config option ' + name)
+        setattr(config, name, value)
+
+    stdout, stderr = sys.stdout, sys.stderr
+    start = time.perf_counter()
+    with open(os.path.join(work_dir, 'extract.log'), 'w') as log:
+        try:
+            sys.stdout = sys.stderr = log
+            config.extract()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    result = OrderedDict()
+    result['total_seconds'] = round(time.perf_counter() - start, 3)
+    result['max_rss_mb'] = max_rss_mb(resource.RUSAGE_SELF) if resource else None
+    result['max_worker_rss_mb'] = max_rss_mb(resource.RUSAGE_CHILDREN) if resource else None
+    result['phases'] = config.benchmark_phases
+    result['absent_phases'] = ABSENT_PHASES
+    result['output_files'], result['output_bytes'] = directory_size(output_dir)
+    return result
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)),
+            stderr = subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def median_results(runs):
+    summary = OrderedDict()
+    summary['total_seconds'] = statistics.median(run['total_seconds'] for run in runs)
+    if runs[0]['max_rss_mb'] is not None:
+        summary['max_rss_mb'] = max(run['max_rss_mb'] for run in runs)
+        summary['max_worker_rss_mb'] = max(run['max_worker_rss_mb'] for run in runs)
+    summary['phases'] = OrderedDict()
+    for phase in BENCHMARK_PHASES:
+        seconds = [run['phases'][phase]['seconds'] for run in runs if phase in run['phases']]
+        if seconds:
+            summary['phases'][phase] = statistics.median(seconds)
+    return summary
+
+# Generates (or reuses) the synthetic backup for size in work_dir and times `repeat` runs of extract()
+def run_benchmark(work_dir, size, options, repeat = 1, geoip = True):
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    mbz_filename = os.path.join(work_dir, 'benchmark-' + '-'.join(str(size[k]) for k in BENCHMARK_SIZE_DEFAULTS) + '.mbz')
+    if not os.path.isfile(mbz_filename):
+        print('Generating', mbz_filename)
+        generate_mbz(mbz_filename, **size)
+    geoip_dir = generate_geoip_csv(os.path.join(work_dir, 'geoip')) if geoip else None
+
+    results = OrderedDict()
+    results['revision'] = git_revision()
+    results['python'] = platform.python_version()
+    results['platform'] = platform.platform()
+    results['started'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    results['size'] = size
+    results['mbz_bytes'] = os.path.getsize(mbz_filename)
+    results['options'] = options
+    results['geoip'] = geoip
+    results['runs'] = []
+    for i in range(repeat):
+        # A new process each time so that ru_maxrss is the peak of this run alone
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context = multiprocessing.get_context('spawn')) as executor:
+            run = executor.submit(benchmark_once, os.path.abspath(mbz_filename), os.path.abspath(os.path.join(work_dir, 'run')), options, geoip_dir).result()
+        print('Run', i + 1, 'of', repeat, ':', run['total_seconds'], 'seconds', run['max_rss_mb'], 'MB')
+        results['runs'].append(run)
+    results['summary'] = median_results(results['runs'])
+    return results
+
+# Compares the median phase times (and peak memory) of two result files. Returns the names of regressions beyond threshold
+def compare_results(base, new, threshold = 0.10):
+    def row(name, before, after, unit):
+        if before is None and after is None:
+            return None
+        if before is None or after is None:
+            print('%-32s %11s %11s' % (name, 'absent' if before is None else '%.2f%s' % (before, unit), 'absent' if after is None else '%.2f%s' % (after, unit)))
+            return None
+        change = (after - before) / before if before else 0.
+        flag = ''
+        # Ignore tiny phases; timing noise dominates them
+        if change > threshold and after - before > (0.05 if unit == 's' else 1.):
+            flag = 'REGRESSION'
+            regressions.append(name)
+        print('%-32s %10.2f%s %10.2f%s %+8.1f%% %s' % (name, before, unit, after, unit, 100. * change, flag))
+
+    regressions = []
+    if base.get('size') != new.get('size') or base.get('geoip') != new.get('geoip'):
+        print('Warning: the benchmarks used different backups', base.get('size'), new.get('size'))
+    print('%-32s %11s %11s %9s' % ('', base.get('revision') or 'base', new.get('revision') or 'new', 'change'))
+    for phase in BENCHMARK_PHASES:
+        row(phase, base['summary']['phases'].get(phase), new['summary']['phases'].get(phase), 's')
+    row('total', base['summary']['total_seconds'], new['summary']['total_seconds'], 's')
+    row('max_rss', base['summary'].get('max_rss_mb'), new['summary'].get('max_rss_mb'), 'M')
+    row('max_worker_rss', base['summary'].get('max_worker_rss_mb'), new['summary'].get('max_worker_rss_mb'), 'M')
+    return regressions
+
+def option_value(text):
+    name, _, value = text.partition('=')
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value # Plain strings do not need quotes e.g. output_format=parquet
+
+def add_size_arguments(parser):
+    for name, default in BENCHMARK_SIZE_DEFAULTS.items():
+        parser.add_argument('--' + name.replace('_', '-'), type = int, default = default)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark MBZ_Extractor_Config.extract() on synthetic Moodle backups')
+    commands = parser.add_subparsers(dest = 'command')
+    commands.required = True
+
+    generate = commands.add_parser('generate', help = 'Write a synthetic mbz')
+    generate.add_argument('mbz')
+    add_size_arguments(generate)
+
+    run = commands.add_parser('run', help = 'Time extract() on a synthetic mbz')
+    add_size_arguments(run)
+    run.add_argument('--work-dir', default = 'benchmark')
+    run.add_argument('--repeat', type = int, default = 1)
+    run.add_argument('--set', action = 'append', default = [], metavar = 'OPTION=VALUE', help = 'MBZ_Extractor_Config option e.g. workers=4 or output_format=parquet')
+    run.add_argument('--no-geoip', action = 'store_true')
+    run.add_argument('--results', help = 'Write the results to this json file')
+
+    compare = commands.add_parser('compare', help = 'Compare two result files')
+    compare.add_argument('base')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type = float, default = 0.10, help = 'Relative slowdown reported as a regression')
+
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        return 1 if compare_results(base, new, args.threshold) else 0
+
+    size = OrderedDict((name, getattr(args, name)) for name in BENCHMARK_SIZE_DEFAULTS)
+    if args.command == 'generate':
+        print(generate_mbz(args.mbz, **size))
+        return 0
+
+    options = OrderedDict(option_value(text) for text in args.set)
+    results = run_benchmark(args.work_dir, size, options, args.repeat, not args.no_geoip)
+    print(json.dumps(results['summary'], indent = 2))
+    if args.results:
+        with open(args.results, 'w') as f:
+            json.dump(results, f, indent = 2)
+    return 0
+
+if __name__ == "__main__" : sys.exit(main())
@@ -64,10 +64,31 @@ def main():
 
 if __name__ == "__main__" : main()
 '''
+''' Many archives, with one geoip load and one anonid mapping for all of them (see extract_batch):
+def main():
+    o = MBZ_Extractor_Config()
+    o.geoip_datadir = 'geoip'
+    o.generate_missing_anonid = 'salt+sha1'
+    o.salt = 'secret-salt-horse-glass-'
+    o.output_directory = 'term-out' # One subdirectory per archive
+    o.batch_workers = 4
+    o.extract_batch(os.path.join('..','data','*.mbz'), anonid_output_filename = 'term_usernames_anonids.csv')
+
+if __name__ == "__main__" : main()
+'''
+''' Only the course event log and forum posts, without the html text columns:
+        o.include_xml_files = ['course/logstores.xml', 'activities/forum_*/forum.xml']
+        o.include_tables = ['logstore_standard_log', 'discussion', 'post']
+        o.exclude_columns = ['*_text']
+'''
+''' The same anonids for a cohort across courses and runs (safe for several extractions at once):
+        o.anonid_database_filename = os.path.join('..','data','cohort_anonids.sqlite')
+'''
 
 #pip install lxml
 #pip install xlsxwriter
 #pip install xlrd
+#pip install pyarrow # Optional. Only needed for the 'parquet' and 'feather' workbook formats
 
 import lxml
 import xlsxwriter
@@ -89,21 +110,179 @@ import tarfile
 import tempfile
 import base64
 # geoip support -
-import bisect
-import ipaddress
+import json
 # timestamp support -
 from datetime import datetime
 # Extract text from html messages -
 from bs4 import BeautifulSoup
 import uuid
 import traceback
+import copy
+import concurrent.futures
+import multiprocessing
+import threading
+import queue
+import collections
+import io
+import shutil
+import sqlite3
+import itertools
+import fnmatch
+import array
+import sys
+import time
+import contextlib
 
 import xlsxwriter
-excelengine = 'xlsxwriter' 
-# 'xlsxwriter' is currently recommended though it did not improve the write speed using generic pandas interface)
-# Todo Perhaps using workbook interface directly will be faster? (https://xlsxwriter.readthedocs.io/)
-# io.excel.xlsx.writer' (default, allegedly slow),
-# 'pyexcelerate' (untested)
+# xlsx files are written with the xlsxwriter workbook interface directly (see write_xlsx_workbook), in constant_memory mode.
+# The generic pandas interface (DataFrame.to_excel) did not improve the write speed with any engine
+
+EXCEL_MAX_ROWS = 1048576
+EXCEL_MAX_COLUMNS = 16384
+
+# Text that pd.ExcelFile.parse reads as NaN (the default na_values of pandas)
+EXCEL_NA_VALUES = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'n/a', 'nan', 'null'}
+
+# Workbook formats (see intermediate_format and output_format)
+WORKBOOK_EXTENSIONS = OrderedDict([('xlsx', '.xlsx'), ('parquet', '.parquet'), ('feather', '.feather')])
+
+
+# The rows of one xml tag (one table, see process_element), stored as columns rather than a dictionary per row.
+# Each column is a list with one value per row; rows without a value hold MISSING_VALUE (NaN), so to_frame()
+# gives the same DataFrame as pd.DataFrame(list_of_row_dictionaries) including the column order.
+# SOURCE_LINE and PARENT_ROW_INDEX are int64 arrays. Column names and short values (e.g. PARENT_SHEET, '0') are interned
+# Moodle's null text $@NULL@$ is stored as '' and repeated leaves are collected in a list that is joined once (see set_value)
+# Values are only stored for the columns accepted by column_selected (None accepts all). Without keep_values only the implicit columns are stored
+class XMLTable:
+    IMPLICIT_COLUMNS = ['SOURCE_LINE', 'PARENT_SHEET', 'PARENT_ROW_INDEX', 'PARENT_ID']
+    INTEGER_COLUMNS = {'SOURCE_LINE': None, 'PARENT_ROW_INDEX': ''} # Integer column -> the one other value it can have (stored as -1)
+    MISSING_VALUE = np.nan
+    INTERN_MAX_LENGTH = 40
+    NULL_TEXT = '$@NULL@$' # Moodle dumps use $@NULL@$ for nulls
+
+    def __init__(self, column_selected = None, keep_values = True):
+        self.column_selected = column_selected
+        self.keep_values = keep_values
+        self.dropped_columns = set()
+        self.row_count = 0
+        self.columns = OrderedDict()
+        self.column_order = dict() # Column -> (first row with a value, when that was set). Used to order the columns like a list of dictionaries
+        self.order_changes = 0
+        self.joined_columns = set() # Columns with repeated leaves i.e. a list of values in some rows
+        self.null_rows = dict() # Column -> rows whose '' was $@NULL@$ (a repeated leaf joins the null text, not '')
+        for i, name in enumerate(self.IMPLICIT_COLUMNS):
+            self.columns[name] = array.array('q') if name in self.INTEGER_COLUMNS else []
+            self.column_order[name] = (-1, i)
+
+    def __len__(self):
+        return self.row_count
+
+    def new_row(self, sourceline, parent_sheet, parent_row_index, parent_id):
+        row = self.row_count
+        self.row_count += 1
+        for name, value in zip(self.IMPLICIT_COLUMNS, [sourceline, parent_sheet, parent_row_index, parent_id]):
+            self.set_value(row, name, value)
+        return row
+
+    # With append, a row that already has a value gets both values e.g. repeated leaves <blah>1</blah><blah>2</blah> become '1,2'
+    # The values are kept in a list until the cell is read, rather than joining the text again for each leaf.
+    # A cell that is exactly $@NULL@$ becomes '' ; a repeated leaf keeps the text e.g. '$@NULL@$,2'
+    def set_value(self, row, name, value, append = False):
+        column = self.columns.get(name)
+        if column is None:
+            if name in self.dropped_columns:
+                return
+            if not self.keep_values or (self.column_selected is not None and not self.column_selected(name)):
+                self.dropped_columns.add(name)
+                return
+            if type(name) is str:
+                name = sys.intern(name)
+            column = self.columns[name] = []
+        elif type(column) is not list:
+            integer = None if append else self.integer_value(name, value)
+            if integer is not None:
+                if row < len(column):
+                    column[row] = integer
+                else:
+                    column.append(integer)
+                return
+            column = self.columns[name] = self.integer_column_values(name, column)
+
+        if type(value) is str and len(value) <= self.INTERN_MAX_LENGTH:
+            value = sys.intern(value)
+        if append and row < len(column) and column[row] is not self.MISSING_VALUE:
+            previous = column[row]
+            if type(previous) is list:
+                previous.append(value)
+            else:
+                if previous == '' and row in self.null_rows.get(name, ()):
+                    previous = self.NULL_TEXT
+                column[row] = [previous, value]
+                self.joined_columns.add(name)
+            return
+        if value == self.NULL_TEXT:
+            value = ''
+            self.null_rows.setdefault(name, set()).add(row)
+        elif name in self.null_rows:
+            self.null_rows[name].discard(row)
+        if row < len(column):
+            column[row] = value
+        else:
+            if row > len(column):
+                column.extend([self.MISSING_VALUE] * (row - len(column)))
+            column.append(value)
+
+        order = self.column_order.get(name)
+        if order is None or row < order[0]:
+            self.column_order[name] = (row, self.order_changes)
+            self.order_changes += 1
+
+    # An integer column stores -1 for its one other value. Returns None for values that can not be stored in the array
+    def integer_value(self, name, value):
+        if type(value) is int and value >= 0:
+            return value
+        other_value = self.INTEGER_COLUMNS[name]
+        if value == other_value and type(value) is type(other_value):
+            return -1
+        return None
+
+    def integer_column_values(self, name, column):
+        other_value = self.INTEGER_COLUMNS[name]
+        return [other_value if value < 0 else value for value in column]
+
+    def get_value(self, row, name):
+        column = self.columns.get(name)
+        if column is None or len(column) <= row:
+            return self.MISSING_VALUE
+        if type(column) is not list and column[row] < 0:
+            return self.INTEGER_COLUMNS[name]
+        value = column[row]
+        if type(value) is list:
+            return ','.join(value)
+        return value
+
+    def has_value(self, row, name):
+        return self.get_value(row, name) is not self.MISSING_VALUE
+
+    # True if any row has more than the implicit columns
+    def has_explicit_columns(self):
+        return len(self.columns) > len(self.IMPLICIT_COLUMNS)
+
+    def to_frame(self):
+        frame_columns = OrderedDict()
+        for name in sorted(self.columns, key = self.column_order.get):
+            column = self.columns[name]
+            if type(column) is not list:
+                values = np.array(column, dtype=np.int64)
+                if (values < 0).any():
+                    values = self.integer_column_values(name, column)
+            else:
+                values = column
+                values.extend([self.MISSING_VALUE] * (self.row_count - len(values)))
+                if name in self.joined_columns:
+                    values = [','.join(value) if type(value) is list else value for value in values]
+            frame_columns[name] = values
+        return pd.DataFrame(frame_columns)
 
 
 class MBZ_Extractor_Config:
@@ -123,35 +302,130 @@ class MBZ_Extractor_Config:
         ,'geoip_time_zone']
     
         self.geoip_geo_columns = self.geoip_all_colnames[2:]
+        self.geoip_numeric_columns = ['geoip_ipfrom','geoip_ipto','geoip_latitude','geoip_longitude']
     
         #geoip_datadir = 'geoip' #change to your local directory of where the downloaded zip has been unpacked
         self.geoipv4_csv = os.path.join(self.geoip_datadir,'IP2LOCATION-LITE-DB11.CSV')
+        # After the first run the columns are cached as .npy files which are memory-mapped on later runs
+        self.geoipv4_cache_dir = os.path.splitext(self.geoipv4_csv)[0] + '-npy'
     
         if os.path.exists(self.geoipv4_csv):
-            print("Reading geoip csv",self.geoipv4_csv)
-            self.geoipv4_df = pd.read_csv(self.geoipv4_csv, names= self.geoip_all_colnames)
-            self.geoipv4_ipvalues = self.geoipv4_df['geoip_ipfrom'].values
-            # bisect searching assumes self.geoipv4_ipvalues are in increasing order 
+            self.geoipv4_data = self.load_geoip_cache()
+            if self.geoipv4_data is None:
+                print("Reading geoip csv",self.geoipv4_csv)
+                geoipv4_df = pd.read_csv(self.geoipv4_csv, names= self.geoip_all_colnames,
+                    dtype = {c: (np.float64 if c in self.geoip_numeric_columns else str) for c in self.geoip_all_colnames}, keep_default_na=False)
+                self.geoipv4_data = OrderedDict()
+                for c in self.geoip_all_colnames:
+                    if c in self.geoip_numeric_columns:
+                        self.geoipv4_data[c] = geoipv4_df[c].values
+                    else:
+                        # Text columns are stored as category codes into a small array of distinct values
+                        codes, values = pd.factorize(geoipv4_df[c])
+                        self.geoipv4_data[c] = (codes.astype(np.int32), np.array(values, dtype=str))
+                geoipv4_df = None
+                self.save_geoip_cache()
+            self.geoipv4_ipvalues = self.geoipv4_data['geoip_ipfrom']
+            # searchsorted assumes self.geoipv4_ipvalues are in increasing order 
         else:
-            self.geoipv4_df = None
+            self.geoipv4_data = None
             self.geoipv4_ipvalues = None
             print("No GeoIP csv data at ",self.geoipv4_csv)
             print("IP addresses will not be converted into geographic locations")
             print("Free Geo-IP data can be downloaded from IP2LOCATION.com")
+    
+    def geoip_cache_signature(self):
+        stat = os.stat(self.geoipv4_csv)
+        return {'csv': os.path.basename(self.geoipv4_csv), 'size': stat.st_size, 'mtime': stat.st_mtime}
+    
+    def load_geoip_cache(self):
+        meta_filename = os.path.join(self.geoipv4_cache_dir, 'meta.json')
+        if not os.path.exists(meta_filename):
+            return None
+        with open(meta_filename) as f:
+            if json.load(f) != self.geoip_cache_signature():
+                print("Ignoring out of date geoip cache", self.geoipv4_cache_dir)
+                return None
+        print("Memory-mapping geoip cache",self.geoipv4_cache_dir)
+        data = OrderedDict()
+        for c in self.geoip_all_colnames:
+            filename = os.path.join(self.geoipv4_cache_dir, c)
+            if c in self.geoip_numeric_columns:
+                data[c] = np.load(filename + '.npy', mmap_mode = 'r')
+            else:
+                data[c] = (np.load(filename + '.codes.npy', mmap_mode = 'r'), np.load(filename + '.values.npy'))
+        return data
+    
+    def save_geoip_cache(self):
+        try:
+            if not os.path.isdir(self.geoipv4_cache_dir):
+                os.makedirs(self.geoipv4_cache_dir)
+            for c,column in self.geoipv4_data.items():
+                filename = os.path.join(self.geoipv4_cache_dir, c)
+                if c in self.geoip_numeric_columns:
+                    np.save(filename + '.npy', column)
+                else:
+                    np.save(filename + '.codes.npy', column[0])
+                    np.save(filename + '.values.npy', column[1])
+            # Written last so an interrupted save is not mistaken for a valid cache
+            with open(os.path.join(self.geoipv4_cache_dir, 'meta.json'),'w') as f:
+                json.dump(self.geoip_cache_signature(), f)
+        except OSError as ex:
+            print("Could not write geoip cache", self.geoipv4_cache_dir, ex)
         
     # # Phase 1 - Extract XMLs from mbz file and create hundreds of Excel files
     
     # Each file can generate a list of tables (dataframes)
     # Recursively process each element. 
-    # For each non-leaf element we build an ordered dictionary of key-value pairs and attach this to an array for the particular element name
-    # <foo id='1' j='a'> becomes data['foo'] = [ {'id':'1', j:'a'} ]
+    # For each non-leaf element we add a row of key-value pairs to the table (an XMLTable) for the particular element name
+    # <foo id='1' j='a'> becomes data['foo'] = rows [ {'id':'1', j:'a'} ]
     # The exception is for leaf elements (no-child elements) in the form e.g. <blah>123</blah>
     # We treat these equivalently to attributes on the surrounding (parent) xml element
-    # <foo id='1'><blah>123</blah></foo> becomes data['foo'] = [ {'id':'1', 'blah':'123'} ]
+    # <foo id='1'><blah>123</blah></foo> becomes data['foo'] = rows [ {'id':'1', 'blah':'123'} ]
     # and no data['blah'] is created
     
     AUTOMATIC_IMPLICIT_XML_COLUMNS = 4 #SOURCE_LINE,PARENT_SHEET,PARENT_INDEX
     
+    # # Selecting xml files, tables and columns (include_xml_files ... exclude_columns)
+    # Patterns are fnmatch patterns e.g. 'activities/forum_*/*.xml', 'grade_*', '*_text'. include None selects everything
+    # Unselected files are skipped (tar members are not read); users.xml is always read for the username -> anonid mapping.
+    # While parsing (filter_while_parsing) an excluded table is skipped with everything inside it, a table that is not included
+    # keeps no values so it is discarded like an empty table (its child rows point at the nearest written ancestor),
+    # and only the columns that are selected or decoded into a selected column are stored (column_needed).
+    # Decoders only run if one of their output columns is selected.
+    # The SOURCE_ and PARENT_ columns are always written.
+    
+    def name_selected(self, kind, name, include, exclude):
+        key = (kind, name)
+        selected = self.selection_cache.get(key)
+        if selected is None:
+            selected = (include is None or any(fnmatch.fnmatchcase(name, pattern) for pattern in include)) and not any(fnmatch.fnmatchcase(name, pattern) for pattern in exclude)
+            self.selection_cache[key] = selected
+        return selected
+    
+    def has_table_or_column_filters(self):
+        return self.include_tables is not None or self.include_columns is not None or len(self.exclude_tables) > 0 or len(self.exclude_columns) > 0
+    
+    def table_selected(self, tablename):
+        return self.name_selected('table', tablename, self.include_tables, self.exclude_tables)
+    
+    def table_excluded(self, tablename):
+        return not self.name_selected('excluded_table', tablename, None, self.exclude_tables)
+    
+    def column_selected(self, column_name):
+        return column_name in XMLTable.IMPLICIT_COLUMNS or self.name_selected('column', column_name, self.include_columns, self.exclude_columns)
+    
+    # Columns stored while parsing: the selected columns and the columns that are decoded into a selected column
+    def column_needed(self, column_name):
+        return self.column_selected(column_name) or self.decoded_columns_selected(column_name)
+    
+    # relative_sub_dir and xml_filename as listed by list_xml_files or archive_xml_files; matched as e.g. 'activities/forum_12/forum.xml'
+    def xml_file_selected(self, relative_sub_dir, xml_filename):
+        if relative_sub_dir in ['.', ''] and os.path.basename(xml_filename) == 'users.xml':
+            return True
+        relative_path = os.path.normpath(os.path.join(relative_sub_dir, os.path.basename(xml_filename))).replace(os.sep, '/')
+        return self.name_selected('xml_file', relative_path, self.include_xml_files, self.exclude_xml_files)
+    
     def process_element(self, data,  tablename_list, context, e):
         #deprecated has_no_children = len(e.getchildren()) == 0
         has_no_children = len(e) == 0
@@ -170,50 +444,104 @@ class MBZ_Extractor_Config:
         # This could be refactored to return a dictionary, so multiple attributes can be attached to the parent
         if has_no_children and (has_no_attribs or ignore_attribs_on_leaves):
             if not has_no_attribs: 
-                print()
-                print("Warning: Ignoring attributes on leaf element:" + e.tag+ ":"+ str(e.attrib))
-                print()
+                self.warn_ignored_leaf_attributes(e)
             return [e.tag,e.text] # Early return, attach the value to the parent (using the tag as the attribute name)
         
-        table_name = e.tag
+        if self.filter_while_parsing and self.table_excluded(e.tag):
+            return [e.tag,None]
+        
+        table, row, child_context = self.new_table_row(data, tablename_list, context, e)
+            
+        for child in e.iterchildren():
+            # Could refactor here to use dictionary to enable multiple key-values from a discarded leaf
+            key,value = self.process_element( data, tablename_list, child_context, child)
+            self.add_leaf_value(table, row, key, value)
+    
+        
+        if has_text:
+            table.set_value(row, 'TEXT', e.text) # If at least some non-whitespace text, then use original text
+        
+        return [e.tag,None]
+    
+    def warn_ignored_leaf_attributes(self, e):
+        print()
+        print("Warning: Ignoring attributes on leaf element:" + e.tag+ ":"+ str(e.attrib))
+        print()
+    
+    # Creates the row for a non-leaf element and returns its table and row index with the context for its children
+    def new_table_row(self, data, tablename_list, context, e):
+        table_name = sys.intern(e.tag)
         if table_name not in data:
             tablename_list.append(table_name)
-            data[table_name] = []
+            if self.filter_while_parsing:
+                data[table_name] = XMLTable(self.column_needed, self.table_selected(table_name))
+            else:
+                data[table_name] = XMLTable()
             
-        key_value_pairs = OrderedDict()
+        # Parent -> child tables, used by discard_empty_tables
+        if table_name not in self.table_children.setdefault(context[0], OrderedDict()):
+            self.table_children[context[0]][table_name] = True
         
-        key_value_pairs['SOURCE_LINE'] = e.sourceline
-        key_value_pairs['PARENT_SHEET'] = context[0]
-        key_value_pairs['PARENT_ROW_INDEX'] = context[1]
-        key_value_pairs['PARENT_ID'] = context[2]
+        table = data[table_name]
         
         #print(e.sourceline)
         # For correctness child_context needs to be after this line and before recursion
-        data[table_name].append(key_value_pairs)
+        row = table.new_row(e.sourceline, context[0], context[1], context[2])
         
         myid = ''
         if 'id' in e.attrib:
             myid = e.attrib['id']
             
-        child_context = [table_name, len(data[table_name])-1, myid] # Used above context[0] during recursive call
+        child_context = [table_name, row, myid] # Used above context[0] during recursive call
         
         for key in sorted(e.attrib.keys()):
-            key_value_pairs[key] = e.attrib[key]
-            
-        for child in e.iterchildren():
-            # Could refactor here to use dictionary to enable multiple key-values from a discarded leaf
-            key,value = self.process_element( data, tablename_list, child_context, child)
-            if value:
-                if key in key_value_pairs:
-                    key_value_pairs[key] += ',' + str(value)
-                else:
-                    key_value_pairs[key] = str(value)
-    
-        
-        if has_text:
-            key_value_pairs['TEXT'] = e.text # If at least some non-whitespace text, then use original text
-        
-        return [e.tag,None]
+            table.set_value(row, key, e.attrib[key])
+        return table, row, child_context
+    
+    def add_leaf_value(self, table, row, key, value):
+        if value:
+            table.set_value(row, key, str(value), append = True)
+    
+    # Streaming equivalent of process_element, built on lxml iterparse.
+    # Whether an element is a leaf is only known once its first child starts (or it ends without one),
+    # so each element waits on the stack until then before its row is created. Rows are therefore created
+    # in the same (document) order as the recursive version, giving the same tables and PARENT_ columns.
+    # Elements are cleared as soon as they end, so memory does not grow with the size of the xml file.
+    # An excluded table (filter_while_parsing) is taken off the stack and its events are skipped until it ends.
+    def process_element_stream(self, data, tablename_list, context, xml_source):
+        stack = [] # [element, table or None (not yet known to be a table), row, child_context]
+        skipped_depth = 0 # Open elements of an excluded table, including the table itself
+        for event, e in ET.iterparse(xml_source, events=('start','end')):
+            if skipped_depth > 0:
+                if event == 'start':
+                    skipped_depth += 1
+                    continue
+                skipped_depth -= 1
+            elif event == 'start':
+                if stack and stack[-1][1] is None:
+                    if self.filter_while_parsing and self.table_excluded(stack[-1][0].tag):
+                        stack.pop()
+                        skipped_depth = 2
+                        continue
+                    parent_context = stack[-2][3] if len(stack) > 1 else context
+                    stack[-1][1:] = self.new_table_row(data, tablename_list, parent_context, stack[-1][0])
+                stack.append([e, None, None, None])
+                continue
+            else:
+                _, table, row, _ = stack.pop()
+                if table is None:
+                    # A leaf e.g. <blah>123</blah> ; attach the value to the parent
+                    if len(e.attrib):
+                        self.warn_ignored_leaf_attributes(e)
+                    if stack:
+                        self.add_leaf_value(stack[-1][1], stack[-1][2], e.tag, e.text)
+                elif e.text is not None and len(e.text.strip()) > 0:
+                    table.set_value(row, 'TEXT', e.text)
+                
+            # Free the consumed element and any earlier siblings that are still attached to the parent
+            e.clear()
+            while e.getprevious() is not None:
+                del e.getparent()[0]
     
     def tablename_to_sheetname(self, elided_sheetnames, tablename):
         sheetname = tablename
@@ -239,22 +567,168 @@ class MBZ_Extractor_Config:
             print("Not base64 latin1?", e)
             return '??Not-latin1 text'
     
-    
-    def decode_geoip(self,ip):
+    # Column version of decode_base64_to_latin1. Each distinct payload is decoded once (e.g. logstore 'other' is mostly 'N;')
+    # and the values that are not base64 are reported once per column. Returns the decoded Series and, with expand_base64_payloads,
+    # an OrderedDict of column name -> Series with the keys of the decoded PHP serialized or JSON payloads e.g. other_forumid
+    def decode_base64_column(self, column_name, values):
+        unique_codes = dict()
+        codes = np.fromiter((unique_codes.setdefault(encoded, len(unique_codes)) for encoded in values), dtype = np.int64, count = len(values))
+        uniques = list(unique_codes.keys())
+        texts = np.empty(len(uniques), dtype = object)
+        payloads = [None] * len(uniques)
+        bad = []
+        for i, encoded in enumerate(uniques):
+            try:
+                raw = base64.b64decode(encoded)
+            except Exception:
+                texts[i] = '??Not-latin1 text'
+                if isinstance(encoded, str):
+                    bad.append(i)
+                continue
+            texts[i] = str(raw, 'latin-1')
+            if self.expand_base64_payloads:
+                payloads[i] = self.parse_payload(raw)
+        
+        if bad:
+            print("Not base64 latin1?", column_name, ":", np.isin(codes, bad).sum(), "value(s) e.g.", [uniques[i][:40] for i in bad[:5]])
+        
+        expanded = OrderedDict()
+        keys = OrderedDict()
+        for payload in payloads:
+            for key in payload or []:
+                keys[key] = True
+        for key in keys:
+            cells = np.empty(len(uniques), dtype = object)
+            cells[:] = [None if payload is None else self.payload_cell(payload.get(key)) for payload in payloads]
+            expanded[column_name + '_' + key] = pd.Series(cells[codes].tolist(), index = values.index) # Typed e.g. int64, float64 or object
+        return pd.Series(texts[codes], index = values.index), expanded
+    
+    # The key/value pairs of a decoded payload as an OrderedDict, or None if it is not a PHP serialized or JSON array/object
+    def parse_payload(self, raw):
         try:
-            ip = ip.strip()
-            if not ip or self.geoipv4_df is None:
-                return pd.Series(None, index=self.geoip_geo_columns)
+            if raw[:1] in (b'{', b'['):
+                value = json.loads(raw, object_pairs_hook = OrderedDict)
+            else:
+                value = self.parse_php_serialized(raw)
+        except (ValueError, IndexError):
+            return None
+        if isinstance(value, list):
+            return OrderedDict((str(i), item) for i, item in enumerate(value))
+        if not isinstance(value, dict):
+            return None
+        if all(type(key) is str and '\0' not in key for key in value):
+            return value
+        # Private and protected object properties are serialized as \0Class\0name and \0*\0name
+        return OrderedDict((str(key).split('\0')[-1], item) for key, item in value.items())
+    
+    # A scalar is used as it is; arrays and objects within the payload are kept as JSON text
+    def payload_cell(self, value):
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, ensure_ascii = False, default = str)
+        return value
+    
+    # N; i:1; d:0.5; b:1; s:4:"view"; a:2:{ O:8:"stdClass":2:{ and the } that ends an array or object
+    PHP_SERIALIZED_TOKEN = re.compile(rb'N;|([idb]):([^;]*);|s:([0-9]+):"|a:([0-9]+):\{|O:[0-9]+:"[^"]*":([0-9]+):\{|\}')
+    
+    # Reads a PHP serialize() value e.g. a:2:{s:7:"forumid";i:1;s:4:"mode";s:4:"view";} that fills the whole of raw
+    # Strings are byte counted; lists become lists, other arrays and objects OrderedDicts. Raises ValueError if it is not PHP serialized
+    def parse_php_serialized(self, raw):
+        stack = [] # [OrderedDict, entries still to read, has key, key, is array] of each open array or object
+        pos = 0
+        while True:
+            match = self.PHP_SERIALIZED_TOKEN.match(raw, pos)
+            if match is None:
+                raise ValueError('Not PHP serialized at ' + str(pos))
+            pos = match.end()
+            token = raw[match.start()]
+            if token == ord('N'):
+                value = None
+            elif match.group(1) is not None:
+                kind, text = match.group(1), match.group(2).decode('ascii')
+                value = int(text) if kind == b'i' else (float(text) if kind == b'd' else text == '1')
+            elif match.group(3) is not None:
+                end = pos + int(match.group(3))
+                if raw[end:end + 2] != b'";':
+                    raise ValueError('Bad PHP serialized string at ' + str(pos))
+                value = self.payload_text(raw[pos:end])
+                pos = end + 2
+            elif token == ord('}'):
+                if not stack or stack[-1][1] != 0 or stack[-1][2]:
+                    raise ValueError('Bad PHP serialized array at ' + str(pos))
+                value, _, _, _, is_array = stack.pop()
+                if is_array and list(value.keys()) == list(range(len(value))):
+                    value = list(value.values()) # A PHP list
+            else:
+                stack.append([OrderedDict(), int(match.group(4) or match.group(5)), False, None, token == ord('a')])
+                continue
             
-            ipv4 = int(ipaddress.IPv4Address(ip))
-            index = bisect.bisect(self.geoipv4_ipvalues, ipv4) - 1
-            entry = self.geoipv4_df.iloc[index]
-            assert entry.geoip_ipfrom  <= ipv4 and entry.geoip_ipto  >= ipv4
-            return entry[2:] # [self.geoip_geo_columns] # Drop ip_from and ip_to
-        except Exception as e:
-            traceback.print_exc()
-            print("Bad ip?",ip, e)
-            return pd.Series(None, index=self.geoip_geo_columns)
+            if not stack:
+                if pos != len(raw):
+                    raise ValueError('Not PHP serialized at ' + str(pos))
+                return value
+            entry = stack[-1]
+            if entry[2]:
+                entry[0][entry[3]] = value
+                entry[1] -= 1
+                entry[2] = False
+            elif entry[1] > 0:
+                entry[2], entry[3] = True, value
+            else:
+                raise ValueError('Bad PHP serialized array at ' + str(pos))
+    
+    def payload_text(self, raw):
+        try:
+            return raw.decode('utf-8')
+        except UnicodeDecodeError:
+            return raw.decode('latin-1')
+    
+    
+    def decode_geoip(self,ip):
+        columns = self.decode_geoip_columns(pd.Series([ip]))
+        return pd.Series([columns[c][0] for c in self.geoip_geo_columns], index=self.geoip_geo_columns)
+    
+    IPV4_PATTERN = r'(?:(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])'
+    
+    # Batch lookup of a column of dotted ipv4 addresses. Returns an OrderedDict of geoip column -> array
+    # Each distinct address is decoded once; the dotted quads are parsed as arrays and located with searchsorted
+    def decode_geoip_columns(self, ips):
+        codes, uniques = pd.factorize(ips)
+        uniques = pd.Series(uniques, dtype=object).astype(str).str.strip()
+        
+        valid = uniques.str.fullmatch(self.IPV4_PATTERN).values
+        bad = uniques[~valid & (uniques != '')]
+        if len(bad) > 0:
+            print("Bad ip?", len(bad), "values e.g.", list(bad[:5]))
+        
+        quads = uniques[valid].str.split('.', expand=True).astype(np.int64).values.reshape(-1,4)
+        ipv4 = (quads[:,0] << 24) | (quads[:,1] << 16) | (quads[:,2] << 8) | quads[:,3]
+        
+        index = np.full(len(uniques), -1, dtype=np.int64)
+        if self.geoipv4_data is not None and len(ipv4) > 0:
+            found = np.searchsorted(self.geoipv4_ipvalues, ipv4, side='right') - 1
+            ipto = np.asarray(self.geoipv4_data['geoip_ipto'])
+            found[(found < 0) | (ipto[np.maximum(found, 0)] < ipv4)] = -1
+            index[valid] = found
+        
+        # Map back from distinct addresses to rows; -1 for missing, bad or unknown addresses
+        row_index = np.where(codes >= 0, index[np.maximum(codes, 0)], -1)
+        missing = row_index < 0
+        row_index[missing] = 0
+        
+        result = OrderedDict()
+        for c in self.geoip_geo_columns:
+            if self.geoipv4_data is None:
+                result[c] = np.full(len(ips), None, dtype=object)
+                continue
+            column = self.geoipv4_data[c]
+            if c in self.geoip_numeric_columns:
+                values = np.asarray(column)[row_index].astype(np.float64)
+                values[missing] = np.nan
+            else:
+                values = column[1][np.asarray(column[0])[row_index]].astype(object)
+                values[missing] = None
+            result[c] = values
+        return result
     
     def decode_unixtimestamp_to_milliseconds(self,seconds):
         if seconds == '':
@@ -276,6 +750,53 @@ class MBZ_Extractor_Config:
             print("Bad unix timestamp?", seconds , e)
             return ''
     
+    # Column versions of decode_unixtimestamp_to_UTC and decode_unixtimestamp_to_milliseconds. Returns (utc, ms) Series.
+    # Each distinct value is converted once, whole numbers in a single numpy datetime64 conversion;
+    # the rest go through int() and float() as before. Bad values are reported once per column
+    def decode_unixtimestamp_columns(self, column_name, seconds):
+        codes, uniques = pd.factorize(seconds)
+        uniques = pd.Series(uniques, dtype = object)
+        text = uniques.where(uniques.map(type) == str, None)
+        blank = (text == '')
+        
+        utc = pd.Series('', index = uniques.index, dtype = object)
+        candidates = text[~blank & text.notna()]
+        try:
+            int_seconds = candidates.astype(np.int64) # Same parsing as int()
+        except (ValueError, TypeError, OverflowError):
+            int_seconds = candidates[candidates.str.fullmatch(r'[+-]?[0-9]{1,12}')].astype(np.int64)
+        # Four digit years (1000-9999) format the same way as strftime
+        int_seconds = int_seconds[(int_seconds >= -30610224000) & (int_seconds <= 253402300799)]
+        as_text = np.datetime_as_string(int_seconds.values.astype('datetime64[s]'), unit = 's') # e.g. 2019-02-12T19:33:20
+        utc[int_seconds.index] = pd.Series(as_text.astype(object), index = int_seconds.index).str.replace('T', ' ', regex = False)
+        
+        bad = []
+        for i in uniques.index[~blank & ~uniques.index.isin(int_seconds.index)]:
+            try:
+                utc[i] = datetime.utcfromtimestamp(int(uniques[i])).strftime('%Y-%m-%d %H:%M:%S')
+            except Exception:
+                bad.append(i)
+        
+        ms = pd.Series(np.nan, index = uniques.index)
+        try:
+            ms[~blank] = 1000. * uniques[~blank].astype(float)
+        except (ValueError, TypeError):
+            for i in uniques.index[~blank]:
+                try:
+                    ms[i] = 1000. * float(uniques[i])
+                except Exception:
+                    if i not in bad:
+                        bad.append(i)
+        
+        if bad:
+            bad_count = np.isin(codes, bad).sum()
+            print("Bad unix timestamp?", column_name, ":", bad_count, "value(s) e.g.", list(uniques[bad[:5]]))
+        
+        # Missing values (code -1) pick up the appended '' and NaN
+        utc_values = np.append(utc.values, '')[codes]
+        ms_values = np.append(ms.values, np.nan)[codes]
+        return pd.Series(utc_values, index = seconds.index), pd.Series(ms_values, index = seconds.index)
+    
     def decode_html_to_text(self,html):
         if html is np.nan:
             return ''
@@ -287,6 +808,168 @@ class MBZ_Extractor_Config:
             print('Bad html?',html, e)
             return '???'
     
+    # Text that BeautifulSoup returns unchanged: no markup, entities, \r, NUL or surrogates and no leading whitespace or BOM
+    PLAIN_TEXT_PATTERN = re.compile('^(?![\t\n\x0c \ufeff])[^<&\r\x00\ud800-\udfff]*$')
+    
+    # Column version of decode_html_to_text. Plain text is used as it is, html is looked up in html_text_cache 
+    # (keyed by a hash of the content) and only the misses are parsed, optionally in batches across html_workers processes
+    def decode_html_column(self, column_name, values):
+        # (pd.factorize would treat text after a NUL character as the same value)
+        unique_codes = dict()
+        codes = np.fromiter((unique_codes.setdefault(html, len(unique_codes)) for html in values), dtype = np.int64, count = len(values))
+        uniques = list(unique_codes.keys())
+        counts = np.bincount(codes, minlength = len(uniques))
+        texts = np.empty(len(uniques), dtype = object)
+        stats = self.html_stats
+        stats['cells'] += len(values)
+        
+        misses = OrderedDict() # hash -> (unique index, html)
+        for i, html in enumerate(uniques):
+            if not isinstance(html, str):
+                texts[i] = self.decode_html_to_text(html)
+                continue
+            if self.PLAIN_TEXT_PATTERN.match(html):
+                texts[i] = html
+                stats['plain'] += counts[i]
+                continue
+            key = hashlib.sha1(html.encode('utf-8', 'surrogatepass')).digest()
+            if key in self.html_text_cache:
+                self.html_text_cache.move_to_end(key)
+                texts[i] = self.html_text_cache[key]
+                stats['cache_hits'] += counts[i]
+            else:
+                misses[key] = (i, html)
+                stats['parsed'] += 1
+                stats['cache_hits'] += counts[i] - 1 # Repeats in this column
+        
+        htmls = [html for i, html in misses.values()]
+        if self.html_workers and len(htmls) > self.html_batch_size:
+            if self.html_pool is None:
+                self.html_pool = self.thread_safe_process_pool(self.html_workers)
+            batches = [htmls[start:start + self.html_batch_size] for start in range(0, len(htmls), self.html_batch_size)]
+            parsed = [text for batch in self.html_pool.map(html_to_text_batch, batches) for text in batch]
+        else:
+            parsed = [self.decode_html_to_text(html) for html in htmls]
+        
+        for (key, (i, html)), text in zip(misses.items(), parsed):
+            texts[i] = text
+            self.html_text_cache[key] = text
+            if len(self.html_text_cache) > self.html_cache_size:
+                self.html_text_cache.popitem(last = False)
+        
+        return pd.Series(texts[codes], index = values.index)
+    
+    def reset_html_stats(self):
+        self.html_stats = {'cells': 0, 'plain': 0, 'cache_hits': 0, 'parsed': 0}
+    
+    def report_html_stats(self):
+        stats = self.html_stats
+        if stats['cells'] == 0:
+            return
+        print("*** HTML to text:", stats['cells'], "cells,", 
+            "{:.1%} plain text,".format(stats['plain'] / stats['cells']), 
+            "{:.1%} cache hits,".format(stats['cache_hits'] / stats['cells']), stats['parsed'], "parsed")
+    
+    def close_html_pool(self):
+        if self.html_pool is not None:
+            self.html_pool.shutdown()
+            self.html_pool = None
+    
+    # # Run report
+    # Wall and CPU time (with rows and bytes where known) of each xml file, column decoder, workbook write, aggregation and phase.
+    # Written to run_report_filename (.json and .csv) in the output directory
+    
+    RUN_REPORT_COLUMNS = ['category', 'name', 'file', 'table', 'column', 'rows', 'bytes', 'wall_seconds', 'cpu_seconds']
+    # cpu_seconds is the CPU time of the thread that ran the block, as the pipeline stages run at the same time in separate threads.
+    # A whole phase is timed by the CPU time of this process (all of its threads, not the worker processes)
+    PROCESS_CPU_CATEGORIES = {'phase'}
+    
+    def reset_run_report(self):
+        self.run_report_records = []
+        self.open_run_report_records = dict() # Thread id -> records that are being timed (see process_files_in_pipeline)
+    
+    # with self.timed('decoder', 'html', column = 'message') as record: ...
+    # The record can be updated inside the block (e.g. record['rows']). file defaults to the file of the enclosing record
+    @contextlib.contextmanager
+    def timed(self, category, name, **fields):
+        record = OrderedDict((column, None) for column in self.RUN_REPORT_COLUMNS)
+        record['category'] = category
+        record['name'] = name
+        open_records = self.open_run_report_records.setdefault(threading.get_ident(), [])
+        if open_records:
+            record['file'] = open_records[-1]['file']
+        record.update(fields)
+        
+        open_records.append(record)
+        cpu_time = time.process_time if category in self.PROCESS_CPU_CATEGORIES else time.thread_time
+        wall_start, cpu_start = time.perf_counter(), cpu_time()
+        try:
+            yield record
+        finally:
+            record['wall_seconds'] = round(time.perf_counter() - wall_start, 6)
+            record['cpu_seconds'] = round(cpu_time() - cpu_start, 6)
+            open_records.pop()
+            self.run_report_records.append(record)
+    
+    # Updates the innermost open record e.g. the rows of the xml file being processed
+    def update_run_report(self, **fields):
+        open_records = self.open_run_report_records.get(threading.get_ident())
+        if open_records:
+            open_records[-1].update(fields)
+    
+    # Total length of the text values (used as the bytes of a decoded column); None unless the column is text
+    def text_length(self, values):
+        if values.dtype != object or pd.api.types.infer_dtype(values, skipna = True) != 'string':
+            return None
+        return int(values.str.len().sum())
+    
+    def total_rows(self, sheets):
+        return sum(len(df) for df in sheets.values())
+    
+    # Size of a file, or of all of the files in a (columnar workbook) directory
+    def path_size(self, path):
+        if not os.path.isdir(path):
+            return os.path.getsize(path) if os.path.exists(path) else None
+        return sum(os.path.getsize(os.path.join(dirpath, filename)) for dirpath, dirnames, filenames in os.walk(path) for filename in filenames)
+    
+    def xml_source_size(self, xml_filename, xml_source):
+        if xml_source is None:
+            return self.path_size(xml_filename)
+        if isinstance(xml_source, bytes):
+            return len(xml_source)
+        return getattr(getattr(xml_source, 'raw', None), 'size', None) # An open archive member (tarfile knows its size)
+    
+    def run_report_summary(self, records):
+        summary = records.groupby(['category', 'name']).agg(count = ('name', 'size'), 
+            rows = ('rows', lambda rows: rows.sum(min_count = 1)), bytes = ('bytes', lambda sizes: sizes.sum(min_count = 1)),
+            wall_seconds = ('wall_seconds', 'sum'), cpu_seconds = ('cpu_seconds', 'sum'))
+        return summary.reset_index().sort_values(['category', 'wall_seconds'], ascending = [True, False])
+    
+    def write_run_report(self, start_time, end_time):
+        records = pd.DataFrame(self.run_report_records, columns = self.RUN_REPORT_COLUMNS)
+        records[['rows', 'bytes']] = records[['rows', 'bytes']].astype('Int64')
+        summary = self.run_report_summary(records)
+        print("*** Run report (totals)")
+        print(summary.to_string(index = False))
+        
+        if not self.run_report_filename or self.dry_run:
+            return
+        report_filename = os.path.join(self.output_directory, self.run_report_filename)
+        print("*** Writing run report", report_filename + '.json', report_filename + '.csv')
+        report = OrderedDict()
+        report['archive_source_file'] = self.archive_source_file
+        report['expanded_archive_directory'] = self.expanded_archive_directory
+        report['started'] = str(start_time)
+        report['finished'] = str(end_time)
+        report['wall_seconds'] = (end_time - start_time).total_seconds()
+        report['workers'] = self.workers
+        report['cpu_seconds'] = "CPU time of the thread that ran each record ('phase' records: of the whole process)"
+        report['summary'] = json.loads(summary.to_json(orient = 'records'))
+        report['records'] = json.loads(records.to_json(orient = 'records'))
+        with open(report_filename + '.json', 'w') as f:
+            json.dump(report, f, indent = 1)
+        records.to_csv(report_filename + '.csv', index = False)
+    
     def validate_anonid_data(self):
         #Expected columns
         for c in ['anonid','userid']:
@@ -302,72 +985,283 @@ class MBZ_Extractor_Config:
         
         self.anonid_df['userid'] = self.anonid_df['userid'].astype(str)
        
+    # The anonid mapping is held in a dictionary (userid -> anonid) for constant time lookups.
+    # self.anonid_df keeps the rows read from anonid_input_filename; generated ids are collected
+    # in self.new_anonid_rows and only merged into it when the mapping is saved at the end
+    # With anonid_database_filename the rows of anonid_input_filename are added to the database instead, 
+    # and anonid_lookup only caches the users that have been looked up (see load_stored_anonids)
+    def load_anonid_data(self):
+        if self.anonid_input_filename:
+            print ('Reading' + self.anonid_input_filename + ' mapping')
+            self.anonid_df = pd.read_csv(self.anonid_input_filename)
+            
+            self.validate_anonid_data()
+        else:
+            self.anonid_df = pd.DataFrame(columns=['userid','moodleid','anonid']) # 'userid':'-1','anonid':'example1234'}])
+        
+        if self.anonid_database_filename:
+            self.import_anonid_rows(self.anonid_df)
+            self.anonid_df = pd.DataFrame(columns=['userid','moodleid','anonid'])
+        
+        self.anonid_lookup = dict(zip(self.anonid_df['userid'], self.anonid_df['anonid'].astype(str)))
+        self.new_anonid_rows = []
+    
+    def save_anonid_data(self, filepath):
+        anonid_df = self.anonid_mapping()
+        print("Writing ",filepath,len(anonid_df.index),'rows')
+        anonid_df.to_csv( filepath, index = None, header=True)
+    
+    # The mapping that is saved. The anonid database may hold many courses, so only the users of this run are saved from it
+    def anonid_mapping(self):
+        if not self.anonid_database_filename:
+            return self.merge_new_anonid_rows()
+        usernames = set(self.anonid_lookup)
+        if getattr(self, 'moodleuser_to_username', None) is not None: # Not set before extract()
+            usernames.update(self.moodleuser_to_username.values())
+        rows = sorted(self.select_stored_anonids(self.anonid_database(), list(usernames)))
+        return pd.DataFrame([row[1:] for row in rows], columns = ['userid','moodleid','anonid'])
+    
+    def merge_new_anonid_rows(self):
+        if len(self.new_anonid_rows) > 0:
+            self.anonid_df = pd.concat([self.anonid_df, pd.DataFrame(self.new_anonid_rows)], ignore_index=True, sort=False)
+            self.new_anonid_rows = []
+        return self.anonid_df
+    
     def userid_to_anonid(self, moodleid):
         if moodleid is np.nan or len(moodleid) == 0:
             return ''
         try:
             username = self.moodleuser_to_username[moodleid] 
-            row = self.anonid_df[ self.anonid_df['userid'] == username]
         except Exception as ex:
             print("**** Unknown moodle user number:", moodleid)
             return ''
-
-        if len( row ) == 1:
-            return str(row['anonid'].values[0])
+        return self.username_to_anonid(username, moodleid)
+    
+    def username_to_anonid(self, username, moodleid):
+        if username in self.anonid_lookup:
+            return self.anonid_lookup[username]
+        
+        if self.anonid_database_filename:
+            self.load_stored_anonids([[username, moodleid]])
+            return self.anonid_lookup.get(username, '')
         
+        result = self.new_anonid(username)
+        if result is None:
+            return ''
+
+        self.anonid_lookup[username] = result
+        self.new_anonid_rows.append({ 'userid':username, 'moodleid': str(moodleid), 'anonid':result})
+            
+        return result
+    
+    # A generated anonid for a user that is not in the mapping; None if generate_missing_anonid is None
+    def new_anonid(self, username):
         if self.generate_missing_anonid == 'uuid4':    
-            result = uuid.uuid4().hex
+            return uuid.uuid4().hex
         elif self.generate_missing_anonid == 'salt+sha1':
            if self.salt is None or len(self.salt) ==0:
-              result = 'anonymized'
+              return 'anonymized'
            else:
-              result =  'p' + hashlib.sha1((self.salt + username).encode('utf-8')).hexdigest()[0:12]
+              return  'p' + hashlib.sha1((self.salt + username).encode('utf-8')).hexdigest()[0:12]
         elif self.generate_missing_anonid is None:
-            return ''
+            return None
         else:
             raise ("self.generate_missing_anonid should be 'uuid4' or 'salt+sha1' or None")
-
-        self.anonid_df = self.anonid_df.append({ 'userid':username, 'moodleid': str(moodleid), 'anonid':result}, ignore_index=True)
-            
-        return result
+    
+    # Vectorized version of userid_to_anonid; each distinct moodle id is only looked up once
+    # With anonid_database_filename the users that are not in anonid_lookup yet are looked up in the database together
+    def userids_to_anonids(self, moodleids):
+        mapping = dict()
+        unique_ids = [moodleid for moodleid in moodleids.unique() if not pd.isna(moodleid)]
+        if self.anonid_database_filename and self.moodleuser_to_username is not None:
+            self.load_stored_anonids([[self.moodleuser_to_username[moodleid], moodleid] for moodleid in unique_ids if moodleid in self.moodleuser_to_username])
+        for moodleid in unique_ids:
+            mapping[moodleid] = self.userid_to_anonid(moodleid)
+        return moodleids.map(mapping).fillna('')
+    
+    # # Anonid database (optional)
+    # anonid_database_filename is an SQLite file with a table anonids (userid TEXT PRIMARY KEY, moodleid, anonid) that is shared by 
+    # every run, course and extractor process, so a cohort keeps the same anonids without re-reading and re-writing a csv file.
+    # Each thread has its own connection. The database uses WAL journaling, so readers do not wait for a writer, 
+    # and a writer waits up to anonid_busy_timeout seconds for another one.
+    
+    def anonid_database(self):
+        connection = self.anonid_connections.get(threading.get_ident())
+        if connection is None:
+            connection = sqlite3.connect(self.anonid_database_filename, timeout = self.anonid_busy_timeout, isolation_level = None, check_same_thread = False)
+            connection.execute('PRAGMA busy_timeout = ' + str(int(self.anonid_busy_timeout * 1000)))
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS anonids (userid TEXT PRIMARY KEY, moodleid TEXT, anonid TEXT NOT NULL)')
+            self.validate_anonid_database(connection)
+            self.anonid_connections[threading.get_ident()] = connection
+        return connection
+    
+    def validate_anonid_database(self, connection):
+        columns = {row[1]: row[5] for row in connection.execute('PRAGMA table_info(anonids)')} # name -> position in the primary key
+        for c in ['userid', 'moodleid', 'anonid']:
+            if c not in columns:
+                raise Exception('The anonids table of \'' + self.anonid_database_filename + '\' should have a column named ' + c)
+        if columns['userid'] != 1:
+            raise Exception('The anonids table of \'' + self.anonid_database_filename + '\' should have userid as its primary key')
+    
+    def close_anonid_database(self):
+        for connection in self.anonid_connections.values():
+            connection.close()
+        self.anonid_connections.clear()
+    
+    # Returns [rowid, userid, moodleid, anonid] of the stored usernames, anonid_lookup_batch_size usernames per query
+    def select_stored_anonids(self, connection, usernames):
+        rows = []
+        for start in range(0, len(usernames), self.anonid_lookup_batch_size):
+            batch = usernames[start:start + self.anonid_lookup_batch_size]
+            rows += connection.execute('SELECT rowid, userid, moodleid, anonid FROM anonids WHERE userid IN (' + ','.join('?' * len(batch)) + ')', batch).fetchall()
+        return rows
+    
+    # Adds users ([username, moodle id]) to anonid_lookup from the database. The users that are not stored yet get new anonids, 
+    # which are added with INSERT OR IGNORE and read back in the same (immediate) transaction: if another process added 
+    # the same user first, its anonid is used, so every process agrees on the anonid of a user
+    def load_stored_anonids(self, users):
+        users = OrderedDict((username, moodleid) for username, moodleid in users if username not in self.anonid_lookup)
+        if len(users) == 0:
+            return
+        connection = self.anonid_database()
+        for _, username, _, anonid in self.select_stored_anonids(connection, list(users)):
+            self.anonid_lookup[username] = anonid
+        
+        new_rows = []
+        for username, moodleid in users.items():
+            if username not in self.anonid_lookup:
+                anonid = self.new_anonid(username)
+                if anonid is not None:
+                    new_rows.append([username, str(moodleid), anonid])
+        if len(new_rows) == 0:
+            return
+        
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('INSERT OR IGNORE INTO anonids (userid, moodleid, anonid) VALUES (?, ?, ?)', new_rows)
+            stored = {username: anonid for _, username, _, anonid in self.select_stored_anonids(connection, [row[0] for row in new_rows])}
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        for username, moodleid, _ in new_rows:
+            self.anonid_lookup[username] = stored[username]
+            self.new_anonid_rows.append({ 'userid':username, 'moodleid': moodleid, 'anonid':stored[username]})
+    
+    # Adds the rows of an anonid csv file (see load_anonid_data) to the database. Users that are already stored keep their anonid
+    def import_anonid_rows(self, anonid_df):
+        connection = self.anonid_database()
+        if len(anonid_df) == 0:
+            return
+        moodleids = anonid_df['moodleid'] if 'moodleid' in anonid_df.columns else pd.Series(np.nan, index = anonid_df.index)
+        rows = [[userid, None if pd.isna(moodleid) else str(moodleid), str(anonid)] for userid, moodleid, anonid in zip(anonid_df['userid'], moodleids, anonid_df['anonid'])]
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            changes = connection.total_changes
+            connection.executemany('INSERT OR IGNORE INTO anonids (userid, moodleid, anonid) VALUES (?, ?, ?)', rows)
+            added = connection.total_changes - changes
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        print('Added', added, 'of', len(rows), 'users to', self.anonid_database_filename)
+    
+    # Columns decoded by to_dataframe
+    BASE64_COLUMNS = ['other','configdata']
+    TIMESTAMP_COLUMNS = ['timestart','timefinish','added','backup_date','original_course_startdate','original_course_enddate','timeadded','firstaccess','lastaccess','lastlogin','currentlogin','timecreated','timemodified','created','modified']
+    HTML_COLUMNS = ['message', 'description','commenttext','intro','conclusion','summary','feedbacktext','content','feedback','info', 'questiontext' , 'answertext']
+    IP_COLUMNS = ['ip','lastip']
+    USERID_COLUMNS = ['userid','relateduserid' , 'realuserid']
+    
+    # The columns that to_dataframe adds for column_name e.g. 'timecreated' -> ['timecreated_utc', 'timecreated_ms']
+    def decoded_column_names(self, column_name):
+        if column_name in self.BASE64_COLUMNS:
+            return [column_name + '_base64']
+        if column_name in self.TIMESTAMP_COLUMNS:
+            return [column_name + '_utc'] + ([column_name + '_ms'] if self.millisecond_times else [])
+        if column_name in self.HTML_COLUMNS:
+            return [column_name + '_text']
+        if column_name in self.IP_COLUMNS and self.geoipv4_data is not None:
+            return self.geoip_geo_columns + [column_name + '_' + geo_col for geo_col in self.geoip_geo_columns]
+        if column_name in self.USERID_COLUMNS:
+            return ['anonid' if column_name == 'userid' else column_name[0:-6] + '_anonid']
+        return []
+    
+    def decoded_columns_selected(self, column_name):
+        if column_name in self.BASE64_COLUMNS and self.expand_base64_payloads and self.payload_columns_selected(column_name):
+            return True
+        return any(self.column_selected(decoded) for decoded in self.decoded_column_names(column_name))
+    
+    # The expanded payload columns are only known once decoded, so any include pattern for e.g. other_* (or starting with a wildcard) selects them
+    def payload_columns_selected(self, column_name):
+        return self.include_columns is None or any(pattern.startswith(column_name + '_') or pattern[:1] in '*?[' for pattern in self.include_columns)
+    
+    def decoder_timed(self, decoder, table_name, values):
+        # The text length is another pass over the column, so it is only measured when the report is written
+        text_length = self.text_length(values) if self.run_report_filename and not self.dry_run else None
+        return self.timed('decoder', decoder, table = table_name, column = values.name, rows = len(values), bytes = text_length)
     
     def to_dataframe(self, table_name, table_data):
-        df = pd.DataFrame(table_data)
-        # Moodle dumps use $@NULL@$ for nulls
-        df.replace('$@NULL@$','',inplace = True)
+        df = table_data.to_frame() # $@NULL@$ is already ''
         
         # We found two base64 encoded columns in Moodle data-
-        for col in df.columns & ['other','configdata']:
-            df[ str(col) + '_base64'] = df[str(col)].map(self.decode_base64_to_latin1)
+        for col in df.columns & self.BASE64_COLUMNS:
+            if not self.decoded_columns_selected(str(col)):
+                continue
+            with self.decoder_timed('base64', table_name, df[str(col)]):
+                text, expanded = self.decode_base64_column(str(col), df[str(col)])
+                df[ str(col) + '_base64'] = text
+                for payload_col, values in expanded.items():
+                    while payload_col in df.columns:
+                        payload_col += '_'
+                    df[payload_col] = values
         
-        for col in df.columns & ['timestart','timefinish','added','backup_date','original_course_startdate','original_course_enddate','timeadded','firstaccess','lastaccess','lastlogin','currentlogin','timecreated','timemodified','created','modified']:
-            df[ str(col) + '_utc'] = df[str(col)].map(self.decode_unixtimestamp_to_UTC)
-            if self.millisecond_times:
-                 df[ str(col) + '_ms'] = df[str(col)].map(self.decode_unixtimestamp_to_milliseconds)
+        for col in df.columns & self.TIMESTAMP_COLUMNS:
+            if not self.decoded_columns_selected(str(col)):
+                continue
+            with self.decoder_timed('utc', table_name, df[str(col)]):
+                utc, ms = self.decode_unixtimestamp_columns(str(col), df[str(col)])
+                df[ str(col) + '_utc'] = utc
+                if self.millisecond_times:
+                     df[ str(col) + '_ms'] = ms
         
         # Extract text from html content
-        for col in df.columns & ['message', 'description','commenttext','intro','conclusion','summary','feedbacktext','content','feedback','info', 'questiontext' , 'answertext']:
-            df[ str(col) + '_text'] = df[str(col)].map(self.decode_html_to_text)
+        for col in df.columns & self.HTML_COLUMNS:
+            if not self.decoded_columns_selected(str(col)):
+                continue
+            with self.decoder_timed('html', table_name, df[str(col)]):
+                df[ str(col) + '_text'] = self.decode_html_column(str(col), df[str(col)])
         
         # Moodle data has 'ip' and 'lastip' that are ipv4 dotted
-        # Currently only ipv4 is implemented. self.geoipv4_df is None if the cvs file was not found
-    
-        if self.geoipv4_df is None:
-            for col in df.columns & ['ip','lastip']:
-                df = df.join( df[str(col)].apply(self.decode_geoip) )
-    
-        for col in df.columns & ['userid','relateduserid' , 'realuserid']:
+        # Currently only ipv4 is implemented. self.geoipv4_data is None if the cvs file was not found
+    
+        if self.geoipv4_data is not None:
+            for col in df.columns & self.IP_COLUMNS:
+                if not self.decoded_columns_selected(str(col)):
+                    continue
+                with self.decoder_timed('geoip', table_name, df[str(col)]):
+                    for geo_col, values in self.decode_geoip_columns(df[str(col)]).items():
+                        if geo_col in df.columns:
+                            geo_col = str(col) + '_' + geo_col # e.g. both ip and lastip in the same table
+                        df[geo_col] = values
+    
+        for col in df.columns & self.USERID_COLUMNS:
             col=str(col)
-            if col == 'userid':
-                out = 'anonid'
-            else: 
-                out = col[0:-6] + '_anonid'
-            df[ out ] = df[col].map(self.userid_to_anonid)
+            out = self.decoded_column_names(col)[0] # e.g. relateduserid -> related_anonid
+            if self.column_selected(out):
+                with self.decoder_timed('anonid', table_name, df[col]):
+                    df[ out ] = self.userids_to_anonids(df[col])
             if self.delete_userids:
                 df.drop(columns=[col],inplace=True)
                 
-        if table_name == 'user':
-            df['anonid'] = df['id'].map(self.userid_to_anonid)
+        if table_name == 'user' and 'id' in df.columns and self.column_selected('anonid'):
+            with self.decoder_timed('anonid', table_name, df['id']):
+                df['anonid'] = self.userids_to_anonids(df['id'])
+        
+        # Columns that were read for a decoder or added by one (e.g. users.xml, 'timecreated' for 'timecreated_utc')
+        if self.include_columns is not None or len(self.exclude_columns) > 0:
+            df = df[[col for col in df.columns if self.column_selected(col)]]
             
         # Can add more MOODLE PROCESSING HERE :-)
         return df
@@ -376,7 +1270,19 @@ class MBZ_Extractor_Config:
     def to_absolute_file_url(self, filepath):
         return urllib.parse.urljoin( 'file:', urllib.request.pathname2url(os.path.abspath(filepath)))
     
-    def write_excel_sheets(self, source_file, excelwriter, data, tablename_list):   
+    # Converts each table into a DataFrame; returns an OrderedDict of sheetname -> DataFrame
+    # The DataFrame index is named after the table (xml tag) and is written as the first column
+    # The moodle id -> username mapping, from the user table of users.xml
+    def read_moodle_usernames(self, data):
+        table = data.get('user')
+        if table is None or len(table) == 0 or not table.has_value(0, 'username'):
+            return
+        assert( self.moodleuser_to_username is None)
+        self.moodleuser_to_username = dict()
+        for row in range(len(table)):
+            self.moodleuser_to_username[ table.get_value(row, 'id') ] = table.get_value(row, 'username') 
+    
+    def build_sheet_frames(self, source_file, data, tablename_list):
         elided_sheetnames = []
         table_sheet_mapping = dict()
         table_sheet_mapping[''] = '' # Top level parents have empty PARENT_SHEET
@@ -385,15 +1291,10 @@ class MBZ_Extractor_Config:
             sheetname = self.tablename_to_sheetname(elided_sheetnames, tablename)
             table_sheet_mapping[tablename] = sheetname
         print('tablename_list:',tablename_list) 
+        frames = OrderedDict()
         for tablename in tablename_list:
-            # Either this is teh user table or we've already process the user table
-            if tablename == 'user' and len(data['user'])>0 and ('username' in data['user'][0].keys()):
-                assert( self.moodleuser_to_username is None)
-                self.moodleuser_to_username = dict()
-                for onerow in data[ tablename ]:
-                    self.moodleuser_to_username[ onerow['id'] ] = onerow['username'] 
-            else:
-                assert( self.moodleuser_to_username is not None)
+            # We've already processed the user table (see read_moodle_usernames)
+            assert( self.moodleuser_to_username is not None)
             df = self.to_dataframe(tablename, data[tablename])
             #Convert table (=original xml tag) into real sheet name (not tag name)
             if 'PARENT_SHEET' in df.columns:
@@ -402,35 +1303,200 @@ class MBZ_Extractor_Config:
             df.index.rename(tablename, inplace=True)
             df.insert(0, 'SOURCE_FILE',source_file ,allow_duplicates=True)
             df.insert(1, 'SOURCE_TAG', tablename, allow_duplicates=True)
-            sheetname = table_sheet_mapping[tablename]
-            
-            if sheetname != tablename:
-                print("Writing "+ tablename + " as sheet "+ sheetname)
+            frames[ table_sheet_mapping[tablename] ] = df
+        return frames
+    
+    # # Workbook storage
+    # A workbook is an xlsx file, or for the columnar formats a directory (e.g. forum.parquet/) 
+    # holding one file per sheet and _sheets.json, which lists the sheets in order
+    
+    def workbook_extension(self, workbook_format):
+        if workbook_format not in WORKBOOK_EXTENSIONS:
+            raise ValueError('Unknown workbook format ' + str(workbook_format) + '; expected one of ' + ', '.join(WORKBOOK_EXTENSIONS.keys()))
+        return WORKBOOK_EXTENSIONS[workbook_format]
+    
+    def workbook_format(self, filename):
+        for workbook_format, extension in WORKBOOK_EXTENSIONS.items():
+            if filename.endswith(extension):
+                return workbook_format
+        raise ValueError('Unknown workbook format for ' + filename)
+    
+    # Writes an OrderedDict of sheetname -> DataFrame. The index is written as the first column
+    def write_workbook(self, output_filename, sheets):
+        workbook_format = self.workbook_format(output_filename)
+        with self.timed('write', workbook_format, file = output_filename, rows = self.total_rows(sheets)) as record:
+            self.write_workbook_format(output_filename, workbook_format, sheets)
+        record['bytes'] = self.path_size(output_filename)
+    
+    def write_workbook_format(self, output_filename, workbook_format, sheets):
+        if os.path.isdir(output_filename):
+            shutil.rmtree(output_filename)
+        elif os.path.exists(output_filename):
+            os.remove(output_filename)
+        
+        if workbook_format == 'xlsx':
+            self.write_xlsx_workbook(output_filename, sheets)
+            return
+        
+        os.mkdir(output_filename)
+        sheet_files = OrderedDict()
+        for sheetname, df in sheets.items():
+            sheet_file = sheetname + WORKBOOK_EXTENSIONS[workbook_format]
+            df = self.columnar_sheet_frame(df)
+            if workbook_format == 'parquet':
+                df.to_parquet(os.path.join(output_filename, sheet_file), index = False)
             else:
-                print("Writing sheet "+ sheetname)
-            
-            df.to_excel(excelwriter, sheet_name=sheetname, index_label=tablename)
-        return table_sheet_mapping
+                df.to_feather(os.path.join(output_filename, sheet_file), compression = 'uncompressed')
+            sheet_files[sheetname] = sheet_file
+        with open(os.path.join(output_filename, '_sheets.json'), 'w') as f:
+            json.dump(sheet_files, f, indent = 1)
+    
+    # Writes the same cells (and header style) as DataFrame.to_excel, row by row so that xlsxwriter's constant_memory mode 
+    # only keeps the current row in memory. A sheet with more rows than Excel allows continues in 'sheet (2)', 'sheet (3)' ...
+    def write_xlsx_workbook(self, output_filename, sheets):
+        workbook = xlsxwriter.Workbook(output_filename, {'constant_memory': True})
+        header_format = workbook.add_format({'bold': True, 'align': 'center', 'valign': 'top', 'top': 1, 'right': 1, 'bottom': 1, 'left': 1})
+        rows_per_sheet = self.excel_max_rows - 1 # The first row is the header
+        try:
+            for sheetname, df in sheets.items():
+                if len(df.columns) + 1 > EXCEL_MAX_COLUMNS:
+                    raise ValueError('Sheet ' + sheetname + ' has ' + str(len(df.columns)) + ' columns; Excel allows ' + str(EXCEL_MAX_COLUMNS))
+                for part, start in enumerate(range(0, max(len(df), 1), rows_per_sheet)):
+                    part_sheetname = sheetname if part == 0 else self.excel_part_sheetname(sheetname, part + 1)
+                    if part > 0:
+                        print("Sheet", sheetname, "has more than", rows_per_sheet, "rows. Continuing in sheet", part_sheetname)
+                    self.write_xlsx_sheet(workbook.add_worksheet(part_sheetname), header_format, df.iloc[start:start + rows_per_sheet])
+        finally:
+            workbook.close()
     
+    def excel_part_sheetname(self, sheetname, part):
+        suffix = ' (' + str(part) + ')'
+        return sheetname[:31 - len(suffix)] + suffix
     
+    def write_xlsx_sheet(self, worksheet, header_format, df):
+        if df.index.name is not None:
+            worksheet.write(0, 0, str(df.index.name), header_format)
+        for col, column_name in enumerate(df.columns, 1):
+            worksheet.write(0, col, self.excel_cell_values(pd.Series([column_name]))[0], header_format)
+        
+        columns = [self.excel_cell_values(df.index.to_series())] + [self.excel_cell_values(df.iloc[:, i]) for i in range(len(df.columns))]
+        write = worksheet.write
+        for row, values in enumerate(zip(*columns), 1):
+            write(row, 0, values[0], header_format) # Like to_excel, the index is in the header style
+            for col in range(1, len(values)):
+                if values[col] is not None:
+                    write(row, col, values[col])
+    
+    # The values that to_excel writes: Python scalars, None for missing values (nothing is written) and 'inf' for infinity
+    def excel_cell_values(self, values):
+        values = self.plain_column_values(values)
+        if pd.api.types.is_bool_dtype(values) or pd.api.types.is_integer_dtype(values):
+            return values.tolist()
+        if pd.api.types.is_float_dtype(values):
+            cells = values.to_numpy(dtype = object)
+            cells[values.isna().values] = None
+            cells[np.isposinf(values.values)] = 'inf'
+            cells[np.isneginf(values.values)] = '-inf'
+            return cells.tolist()
+        return [value if type(value) is str else self.excel_cell_value(value) for value in values.tolist()]
+    
+    def excel_cell_value(self, value):
+        if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+            return None
+        if isinstance(value, (bool, np.bool_)):
+            return bool(value)
+        if isinstance(value, (int, np.integer)):
+            return int(value)
+        if isinstance(value, (float, np.floating)):
+            if np.isinf(value):
+                return 'inf' if value > 0 else '-inf'
+            return float(value)
+        if isinstance(value, (datetime, pd.Timestamp)):
+            return value
+        return str(value)
+    
+    # Same layout as the xlsx sheet: the index becomes the first column (unnamed indexes are called INDEX), 
+    # repeated column names are renamed attempt.1 ... and columns with mixed value types are stored as text
+    def columnar_sheet_frame(self, df):
+        df = df.copy(deep = False)
+        df.insert(0, df.index.name or 'INDEX', df.index, allow_duplicates = True)
+        df.index = pd.RangeIndex(len(df))
+        df.columns = self.dedupe_column_names([str(column) for column in df.columns])
+        for column in df.columns:
+            df[column] = self.plain_column_values(df[column])
+            if df[column].dtype == object and pd.api.types.infer_dtype(df[column], skipna = True) not in ('string', 'empty', 'boolean'):
+                df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+        return df
     
-    def re_adopt_child_table(self, data, parent_tablename, parent_table, child_tablename):
-        child_table = data[child_tablename]
-        for row in child_table:
-            if 'PARENT_SHEET' not in row.keys():
-                continue
-            if row['PARENT_SHEET'] == parent_tablename:
-                idx = row['PARENT_ROW_INDEX']
-                # Time to follow the pointer
-                parent_row = parent_table[idx]
-                #row['PARENT_TAG'] = parent_row['PARENT_TAG']
-                row['PARENT_ROW_INDEX'] = parent_row['PARENT_ROW_INDEX']
-                row['PARENT_ID'] = parent_row['PARENT_ID']
-                row['PARENT_SHEET'] = parent_row['PARENT_SHEET']
+    # Returns an OrderedDict of sheetname -> DataFrame with the same values that pd.ExcelFile.parse would return
+    def read_workbook(self, filename):
+        sheets = OrderedDict()
+        workbook_format = self.workbook_format(filename)
+        if workbook_format == 'xlsx':
+            xl = pd.ExcelFile(filename)
+            for sheet in xl.sheet_names:
+                first_part = self.excel_first_part_sheetname(sheet, sheets)
+                if first_part:
+                    sheets[first_part] = pd.concat([sheets[first_part], xl.parse(sheet)], ignore_index = True, sort = False)
+                else:
+                    sheets[sheet] = xl.parse(sheet)
+            xl.close()
+            return sheets
         
+        import pyarrow.feather
+        with open(os.path.join(filename, '_sheets.json')) as f:
+            sheet_files = json.load(f, object_pairs_hook = OrderedDict)
+        for sheet, sheet_file in sheet_files.items():
+            sheet_file = os.path.join(filename, sheet_file)
+            if workbook_format == 'parquet':
+                df = pd.read_parquet(sheet_file)
+            else:
+                df = pyarrow.feather.read_table(sheet_file, memory_map = True).to_pandas()
+            self.excel_value_types(df)
+            sheets[sheet] = df
+        return sheets
+    
+    # The sheet that 'sheet (2)', 'sheet (3)' ... continue (see write_xlsx_workbook), or None. 
+    # Table names are xml tags, which never contain spaces or brackets
+    def excel_first_part_sheetname(self, sheet, sheets):
+        match = re.match(r'^(.*) \((\d+)\)$', sheet)
+        if not match or len(sheets) == 0:
+            return None
+        last_sheet = list(sheets.keys())[-1]
+        return last_sheet if last_sheet.startswith(match.group(1)) else None
+    
+    # Returns an OrderedDict of sheetname -> column names. The columnar formats only read the file schemas
+    def read_workbook_columns(self, filename):
+        sheet_columns = OrderedDict()
+        workbook_format = self.workbook_format(filename)
+        if workbook_format == 'xlsx':
+            xl = pd.ExcelFile(filename)
+            for sheet in xl.sheet_names:
+                if not self.excel_first_part_sheetname(sheet, sheet_columns):
+                    sheet_columns[sheet] = list(xl.parse(sheet,nrows=1).columns)
+            xl.close()
+            return sheet_columns
         
+        import pyarrow.parquet, pyarrow.ipc
+        with open(os.path.join(filename, '_sheets.json')) as f:
+            sheet_files = json.load(f, object_pairs_hook = OrderedDict)
+        for sheet, sheet_file in sheet_files.items():
+            sheet_file = os.path.join(filename, sheet_file)
+            if workbook_format == 'parquet':
+                sheet_columns[sheet] = pyarrow.parquet.read_schema(sheet_file).names
+            else:
+                with pyarrow.memory_map(sheet_file) as source:
+                    sheet_columns[sheet] = pyarrow.ipc.open_file(source).schema.names
+        return sheet_columns
+    
+    
+    
+    # Tables that only have the implicit columns (e.g. <questions> that only wraps <question> elements) are not written.
+    # The rows of their child tables are re-parented to the nearest written ancestor row. 
+    # table_children (recorded by new_table_row) says which tables can have rows that point at an empty table
     def discard_empty_tables(self, data,tablename_list):
         nonempty_tables = []
+        empty_tables = set()
         for tablename in tablename_list:
             table = data[tablename]
             # print(tablename, len(table),'rows')
@@ -438,46 +1504,147 @@ class MBZ_Extractor_Config:
                 # print("Skipping empty table",tablename)
                 continue
                 
-            include = False
-            for row in table:
-                if len(row) > self.AUTOMATIC_IMPLICIT_XML_COLUMNS: # Found more than just PARENT_TAG,... columns
-                    include = True
-                    break
-            
-            if include:
+            if table.has_explicit_columns() and self.table_selected(tablename): # Found more than just PARENT_TAG,... columns
                 # print("Including",tablename)
                 nonempty_tables.append(tablename)
             else:
                 # print("Skipping unnecessary table",tablename)
-                # Will need to fixup child items that still think this is their container
-                # More efficient if we kept a mapping of child tables, rather than iterate over tables
-                for childname in tablename_list:
-                    self.re_adopt_child_table(data, tablename, table, childname)
-                pass
+                empty_tables.add(tablename)
+        
+        child_tables = OrderedDict()
+        for tablename in tablename_list:
+            if tablename in empty_tables:
+                for childname in self.table_children.get(tablename, ()):
+                    child_tables[childname] = True
+        
+        resolved = set() # (table, row) of the empty table rows that already point at their nearest written ancestor
+        for childname in child_tables:
+            table = data[childname]
+            for row in range(len(table)):
+                if table.get_value(row, 'PARENT_SHEET') in empty_tables:
+                    self.re_adopt_row(data, empty_tables, resolved, childname, row)
     
         return nonempty_tables
     
+    # Points the row at the nearest ancestor row that is not in empty_tables. 
+    # Every empty table row on the way is updated too, so each chain of empty wrapper tables is only followed once
+    def re_adopt_row(self, data, empty_tables, resolved, tablename, row):
+        chain = []
+        parent = self.parent_row(data, tablename, row)
+        while data[parent[0]].get_value(parent[1], 'PARENT_SHEET') in empty_tables and parent not in resolved:
+            chain.append(parent)
+            parent = self.parent_row(data, *parent)
+        
+        parent_table = data[parent[0]]
+        for adopted_tablename, adopted_row in chain + [(tablename, row)]:
+            for name in ['PARENT_SHEET', 'PARENT_ROW_INDEX', 'PARENT_ID']:
+                data[adopted_tablename].set_value(adopted_row, name, parent_table.get_value(parent[1], name))
+            resolved.add((adopted_tablename, adopted_row))
+    
+    def parent_row(self, data, tablename, row):
+        table = data[tablename]
+        return (table.get_value(row, 'PARENT_SHEET'), table.get_value(row, 'PARENT_ROW_INDEX'))
+    
     #self.output_directory, relative_sub_dir, os.path.join(xml_dir,filename)    
-    def process_one_file(self,  relative_sub_dir, xml_filename):
+    # xml_source (optional) is an open file or bytes to parse instead of reading xml_filename e.g. a member of the mbz archive
+    # Parsing, building the frames and writing them are separate steps so they can also run as stages of a pipeline (see process_files_in_pipeline)
+    def process_one_file(self,  relative_sub_dir, xml_filename, xml_source = None):
+        parsed = self.parse_one_file(relative_sub_dir, xml_filename, xml_source)
+        if parsed is None:
+            return
+        
+        if self.aggregate_in_memory:
+            self.write_file_frames(*self.build_file_frames(*parsed))
+            return
+        
+        print("** Writing ", parsed[0])
+            
+        try:
+            self.write_file_frames(*self.build_file_frames(*parsed))
+        except Exception as ex:
+            traceback.print_exc()
+            print(type(ex))
+            print(ex)
+            pass
+        print()
+    
+    # Returns [output_filename, source_file, cache_key, data, nonempty_tables] for build_file_frames, or None if there is nothing to write
+    def parse_one_file(self, relative_sub_dir, xml_filename, xml_source = None):
         print('process_one_file(\''+self.output_directory+'\',\''+relative_sub_dir+'\',\''+xml_filename+'\')')
         #print("Reading XML " + xml_filename)
-        #Original parser 
-        xmlroot = ET.parse(xml_filename).getroot()
-        # Use lxml
-        #xmlroot = etree.parse(xml_filename)
-            
+        output_filename = self.xml_file_to_output_filename(relative_sub_dir, xml_filename)
+        
+        # absolute path is useful to open original files on local machine
+        if(False):
+            source_file = to_absolute_file_url(xml_filename)
+        else:
+            source_file = os.path.normpath(xml_filename)
+        
+        if xml_source is None:
+            xml_source = xml_filename
+        elif isinstance(xml_source, bytes):
+            xml_source = io.BytesIO(xml_source)
+        
+        cache_key = None
+        if self.xml_cache_directory:
+            cache_key, xml_source = self.xml_cache_key(source_file, xml_source)
+            # users.xml is always processed; it sets up the username and anonid mappings
+            if not xml_filename.endswith('users.xml') and self.use_cached_output(output_filename, cache_key):
+                return None
+        
         data = dict()
         tablename_list = []
+        self.table_children = dict()
+        # users.xml is read in full; its tables and columns are selected when they are written
+        file_selected = self.xml_file_selected(relative_sub_dir, xml_filename)
+        self.filter_while_parsing = self.has_table_or_column_filters() and not xml_filename.endswith('users.xml')
         
         initial_context = ['','',''] # Todo : Consider missing integer index e.g. ['',None,'']
-        self.process_element(data, tablename_list, initial_context, xmlroot)
+        if self.streaming_xml_parser:
+            self.process_element_stream(data, tablename_list, initial_context, xml_source)
+        else:
+            #Original parser 
+            xmlroot = ET.parse(xml_source).getroot()
+            self.process_element(data, tablename_list, initial_context, xmlroot)
+            xmlroot = None
+        self.filter_while_parsing = False
+        self.read_moodle_usernames(data)
+        if cache_key and xml_filename.endswith('users.xml'):
+            cache_key = self.add_anonid_mapping_to_fingerprint(cache_key)
+        if not file_selected:
+            return None
         
         nonempty_tables = self.discard_empty_tables(data,tablename_list)
+        self.update_run_report(rows = sum(len(data[tablename]) for tablename in nonempty_tables))
         
         if len(nonempty_tables) == 0:
             #print("no tables left to write")
+            self.save_cached_output(output_filename, cache_key, None)
+            return None
+        
+        if self.dry_run and not self.aggregate_in_memory: # For debugging
+            return None
+        return [output_filename, source_file, cache_key, data, nonempty_tables]
+    
+    # Decodes the parsed tables (to_dataframe). Returns [output_filename, cache_key, frames] for write_file_frames
+    def build_file_frames(self, output_filename, source_file, cache_key, data, nonempty_tables):
+        return [output_filename, cache_key, self.build_sheet_frames(source_file, data, nonempty_tables)]
+    
+    def write_file_frames(self, output_filename, cache_key, frames):
+        self.save_cached_output(output_filename, cache_key, frames)
+        if self.aggregate_in_memory:
+            self.keep_in_memory_workbook(output_filename, frames)
             return
         
+        for sheetname, df in frames.items():
+            tablename = df.index.name
+            if sheetname != tablename:
+                print("Writing "+ tablename + " as sheet "+ sheetname)
+            else:
+                print("Writing sheet "+ sheetname)
+        self.write_workbook(output_filename, frames)
+    
+    def xml_file_to_output_filename(self, relative_sub_dir, xml_filename):
         # We use underscore to collate source subdirectories
         basename = os.path.basename(xml_filename).replace('.xml','').replace('_','')
         
@@ -488,61 +1655,386 @@ class MBZ_Extractor_Config:
             if not os.path.exists(output_dir): 
                 os.mkdirs(output_dir)
     
-            output_filename = os.path.join(output_dir,  basename + '.xlsx')
+            output_filename = os.path.join(output_dir,  basename + self.workbook_extension(self.intermediate_format))
         else:
             sub = relative_sub_dir.replace(os.sep,'_').replace('.','')
             if (len(sub) > 0) and sub[-1] != '_':
                 sub = sub + '_'
-            output_filename = os.path.join(self.output_directory,  sub +  basename + '.xlsx')
+            output_filename = os.path.join(self.output_directory,  sub +  basename + self.workbook_extension(self.intermediate_format))
+        return output_filename
+    
+    # # Incremental re-runs (incremental = True)
+    # The tables of each xml file are pickled in xml_cache_directory, named after a hash of the xml content, its path 
+    # and the options that change the output (incremental_fingerprint). An unchanged file is not parsed again. 
+    # After phase 1 the ALL_ workbooks whose sources are all unchanged (and that still exist) are not rebuilt;
+    # manifest.json remembers the source keys of each ALL_ workbook
+    
+    INCREMENTAL_CACHE_VERSION = 2
+    XML_HASH_CHUNK_SIZE = 1 << 20
+    XML_SPOOL_MAX_SIZE = 64 << 20 # Larger xml members are spooled to disk while they are hashed
+    INCREMENTAL_OPTIONS = ['generate_missing_anonid', 'salt', 'anonid_database_filename', 'delete_userids', 'millisecond_times', 'expand_base64_payloads', 'include_tables', 'exclude_tables', 'include_columns', 'exclude_columns']
+    
+    def incremental_fingerprint(self):
+        options = OrderedDict((name, getattr(self, name, None)) for name in self.INCREMENTAL_OPTIONS)
+        options['version'] = self.INCREMENTAL_CACHE_VERSION
+        if self.anonid_input_filename:
+            with open(self.anonid_input_filename, 'rb') as f:
+                options['anonid_input'] = hashlib.sha1(f.read()).hexdigest()
+        if self.geoipv4_data is not None:
+            options['geoip'] = self.geoip_cache_signature()
+        return json.dumps(options, sort_keys = True, default = str)
+    
+    def start_incremental_run(self):
+        self.xml_cache_directory = None
+        self.cached_outputs = OrderedDict() # output filename -> pickle with the cached tables
+        self.output_cache_keys = OrderedDict() # output filename -> cache key, for every file with tables
+        self.used_cache_keys = set()
+        if not self.incremental or self.dry_run:
+            return
+        if self.generate_missing_anonid == 'uuid4' and not self.anonid_input_filename and not self.anonid_database_filename:
+            print("*** Not using the incremental cache: uuid4 anonids change on every run unless anonid_input_filename or anonid_database_filename is set")
+            return
+        self.xml_cache_directory = self.incremental_cache_directory or os.path.join(self.output_directory, '_CACHE_')
+        if not os.path.isdir(self.xml_cache_directory):
+            os.makedirs(self.xml_cache_directory)
+        self.fingerprint = self.incremental_fingerprint()
+        print("*** Incremental cache:", self.xml_cache_directory)
+    
+    # Hashes the xml in chunks. Returns the cache key and the source to parse: the same file name or BytesIO (rewound), 
+    # or for other file objects (e.g. tar members, which may not seek) a copy that was spooled to a temporary file while hashing
+    def xml_cache_key(self, source_file, xml_source):
+        digest = hashlib.sha1(self.fingerprint.encode('utf-8'))
+        digest.update(source_file.encode('utf-8') + b'\0')
+        if isinstance(xml_source, io.BytesIO):
+            digest.update(xml_source.getbuffer())
+            return digest.hexdigest(), xml_source
+        if isinstance(xml_source, str):
+            with open(xml_source, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.XML_HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            return digest.hexdigest(), xml_source
+        copy = tempfile.SpooledTemporaryFile(max_size = self.XML_SPOOL_MAX_SIZE)
+        for chunk in iter(lambda: xml_source.read(self.XML_HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            copy.write(chunk)
+        copy.seek(0)
+        return digest.hexdigest(), copy
+    
+    # The cached tables hold anonids, so the anonid of every user in users.xml becomes part of the fingerprint (and of the key of users.xml).
+    # Every anonid must already be fixed: uuid4 anonids that are not in anonid_input_filename would be new in each run, 
+    # so the cache is not used. With anonid_database_filename the missing users are added to the database first
+    def add_anonid_mapping_to_fingerprint(self, cache_key):
+        if self.moodleuser_to_username is None:
+            return cache_key
+        users = [[username, moodleid] for moodleid, username in self.moodleuser_to_username.items() if isinstance(username, str)]
+        usernames = sorted(set(username for username, _ in users))
+        if self.anonid_database_filename:
+            self.load_stored_anonids(users)
         
-        if self.dry_run: # For debugging
+        digest = hashlib.sha1(self.fingerprint.encode('utf-8'))
+        for username in usernames:
+            if username in self.anonid_lookup:
+                anonid = self.anonid_lookup[username]
+            elif self.generate_missing_anonid == 'uuid4':
+                print("*** Not using the incremental cache:", username, "and maybe other users have no anonid in", self.anonid_input_filename, "(uuid4 anonids change on every run)")
+                self.xml_cache_directory = None
+                return None
+            else:
+                anonid = self.new_anonid(username) # Not recorded; only the users that are looked up are saved
+            digest.update(json.dumps([username, anonid]).encode('utf-8'))
+        self.fingerprint = digest.hexdigest()
+        return hashlib.sha1((cache_key + self.fingerprint).encode('utf-8')).hexdigest()
+    
+    def cached_output_filename(self, cache_key, has_tables):
+        return os.path.join(self.xml_cache_directory, cache_key + ('.pkl' if has_tables else '.empty'))
+    
+    def use_cached_output(self, output_filename, cache_key):
+        if os.path.exists(self.cached_output_filename(cache_key, False)):
+            print("Unchanged, no tables")
+            self.used_cache_keys.add(cache_key)
+            return True
+        cached_filename = self.cached_output_filename(cache_key, True)
+        if not os.path.exists(cached_filename):
+            return False
+        print("Unchanged, using cached tables")
+        self.used_cache_keys.add(cache_key)
+        self.output_cache_keys[output_filename] = cache_key
+        self.cached_outputs[output_filename] = cached_filename
+        return True
+    
+    def save_cached_output(self, output_filename, cache_key, frames):
+        if cache_key is None:
             return
+        self.used_cache_keys.add(cache_key)
+        if frames is None:
+            open(self.cached_output_filename(cache_key, False), 'w').close()
+            return
+        self.output_cache_keys[output_filename] = cache_key
+        # Written under a temporary name so that an interrupted run does not leave a partial pickle
+        cached_filename = self.cached_output_filename(cache_key, True)
+        pd.to_pickle(frames, cached_filename + '.tmp')
+        os.replace(cached_filename + '.tmp', cached_filename)
+    
+    def incremental_manifest_filename(self):
+        return os.path.join(self.xml_cache_directory, 'manifest.json')
+    
+    # Called after phase 1. Unchanged ALL_ workbooks are kept; the sources of the others are written 
+    # (or kept in memory) from the cache so that the usual aggregation steps find them
+    def prepare_incremental_aggregation(self):
+        if not self.xml_cache_directory:
+            return
+        manifest = {'targets': {}}
+        if os.path.exists(self.incremental_manifest_filename()):
+            with open(self.incremental_manifest_filename()) as f:
+                manifest = json.load(f)
         
-        print("** Writing ", output_filename)
-    
-        if os.path.exists(output_filename):
-            os.remove(output_filename)
-           
-        excelwriter = pd.ExcelWriter(output_filename, engine= excelengine)
+        self.aggregation_keys = OrderedDict()
+        for targetfile, sources in self.aggregation_sources(sorted(self.output_cache_keys.keys(), key = self.natural_sort_key)).items():
+            digest = hashlib.sha1(self.fingerprint.encode('utf-8'))
+            digest.update(json.dumps([self.sqlite_output_filename] + [[os.path.basename(file), self.output_cache_keys[file]] for file in sources]).encode('utf-8'))
+            target_key = digest.hexdigest()
+            self.aggregation_keys[os.path.basename(targetfile)] = target_key
             
-        # absolute path is useful to open original files on local machine
-        if(False):
-            source_file = to_absolute_file_url(xml_filename)
+            if manifest['targets'].get(os.path.basename(targetfile)) == target_key and os.path.exists(targetfile):
+                print("Unchanged", targetfile, "(" + str(len(sources)) + " files)")
+                for file in sources:
+                    self.discard_output(file)
+            else:
+                for file in sources:
+                    self.restore_cached_output(file)
+    
+    def discard_output(self, output_filename):
+        self.cached_outputs.pop(output_filename, None)
+        if self.aggregate_in_memory:
+            self.in_memory_workbooks.pop(output_filename, None)
+        elif os.path.isdir(output_filename):
+            shutil.rmtree(output_filename)
+        elif os.path.exists(output_filename):
+            os.remove(output_filename)
+    
+    def restore_cached_output(self, output_filename):
+        cached_filename = self.cached_outputs.pop(output_filename, None)
+        if cached_filename is None:
+            return
+        frames = pd.read_pickle(cached_filename)
+        if self.aggregate_in_memory:
+            self.keep_in_memory_workbook(output_filename, frames)
         else:
-            source_file = os.path.normpath(xml_filename)
-            
-        try:
-            self.write_excel_sheets(source_file, excelwriter, data,nonempty_tables)
-            excelwriter.close()
-        except Exception as ex:
-            traceback.print_exc()
-            print(type(ex))
-            print(ex)
-            pass
-        finally:
-            
-            excelwriter = None
-        print()
+            print("** Writing cached tables", output_filename)
+            self.write_workbook(output_filename, frames)
+    
+    # Records the aggregated workbooks and removes the cached tables of xml files that are no longer in the archive
+    def finish_incremental_run(self):
+        if not self.xml_cache_directory:
+            return
+        with open(self.incremental_manifest_filename(), 'w') as f:
+            json.dump({'version': self.INCREMENTAL_CACHE_VERSION, 'targets': self.aggregation_keys}, f, indent = 1)
+        for cached_filename in glob.glob(os.path.join(self.xml_cache_directory, '*.pkl')) + glob.glob(os.path.join(self.xml_cache_directory, '*.empty')):
+            if os.path.splitext(os.path.basename(cached_filename))[0] not in self.used_cache_keys:
+                os.remove(cached_filename)
 
     def process_directory(self, relative_sub_dir):
+        for xml_sub_dir, xml_filename in self.list_xml_files(relative_sub_dir):
+            self.process_listed_file(xml_sub_dir, xml_filename)
+    
+    def process_listed_file(self, relative_sub_dir, xml_filename, xml_source = None):
+        print("Processing", os.path.basename(xml_filename))
+        assert((self.moodleuser_to_username is not None) or xml_filename.endswith('users.xml'))
+        with self.timed('xml_file', os.path.basename(xml_filename), file = os.path.normpath(xml_filename), bytes = self.xml_source_size(xml_filename, xml_source)):
+            self.process_one_file( relative_sub_dir, xml_filename, xml_source)
+    
+    # Returns [relative_sub_dir, xml_filename] pairs in processing order
+    def list_xml_files(self, relative_sub_dir):
         xml_dir = os.path.join(self.expanded_archive_directory, relative_sub_dir)
         # We want to process the users.xml first
         file_list = sorted(os.listdir(xml_dir), reverse = True)
-         
+        
+        xml_files = []
         for filename in file_list:
-            if filename.endswith('.xml'):
-                print("Processing", filename)
-                assert((self.moodleuser_to_username is not None) or filename.endswith('users.xml'))
-                self.process_one_file( relative_sub_dir, os.path.join(xml_dir,filename))
+            if filename.endswith('.xml') and self.xml_file_selected(relative_sub_dir, filename):
+                xml_files.append([relative_sub_dir, os.path.join(xml_dir,filename)])
         
         if self.toplevel_xml_only:
-            return # No recursion into subdirs(e.g. for testing)
+            return xml_files # No recursion into subdirs(e.g. for testing)
         
         # Recurse
         for filename in file_list:
             candidate_sub_dir = os.path.join(relative_sub_dir, filename)
             if os.path.isdir( os.path.join(self.expanded_archive_directory, candidate_sub_dir)) :   
-                self.process_directory(candidate_sub_dir)
+                xml_files += self.list_xml_files(candidate_sub_dir)
+        return xml_files
+    
+    # Phase 1 across a process pool (self.workers > 1)
+    # users.xml is processed here first; every other file only needs its moodle id -> username mapping (and anonids),
+    # so the remaining files are independent and are sent to the pool. Worker results are merged in the same order
+    # as a serial run, so the anonid mapping and aggregation inputs do not depend on which worker finished first.
+    # xml_files may also yield [relative_sub_dir, xml_filename, open file] (see archive_xml_files); the file contents are sent to the worker.
+    # At most 2 files per worker are in flight, which also bounds the memory used by file contents and results waiting to be merged.
+    def process_files_in_parallel(self, xml_files):
+        xml_files = iter(xml_files)
+        while self.moodleuser_to_username is None:
+            xml_file = next(xml_files, None)
+            if xml_file is None:
+                return
+            self.process_listed_file(*xml_file)
+        
+        print("*** Processing xml files using", self.workers, "worker processes")
+        with concurrent.futures.ProcessPoolExecutor(self.workers, initializer = init_pool_worker, initargs = (self.pool_worker_config(),)) as pool:
+            pending = collections.deque()
+            for xml_file in xml_files:
+                if len(xml_file) > 2:
+                    xml_file = xml_file[:2] + [xml_file[2].read()]
+                pending.append(pool.submit(process_file_in_pool_worker, *xml_file))
+                if len(pending) >= 2 * self.workers:
+                    self.merge_worker_results(pending.popleft().result())
+            while len(pending) > 0:
+                self.merge_worker_results(pending.popleft().result())
+    
+    # A process pool that may be started while other threads are running: html_pool and pipeline_writer start their processes 
+    # on the first submit, from a pipeline stage. A forked child would inherit the locks those threads hold, so the processes
+    # are started by a fork server (or spawned where there is none). Scripts need the if __name__ == "__main__" guard, as on Windows.
+    def thread_safe_process_pool(self, max_workers, **options):
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        return concurrent.futures.ProcessPoolExecutor(max_workers, mp_context = multiprocessing.get_context(start_method), **options)
+    
+    # A shallow copy for the worker processes, without the large or process-specific state
+    def pool_worker_config(self):
+        worker_config = copy.copy(self)
+        worker_config.in_memory_workbooks = OrderedDict()
+        worker_config.new_anonid_rows = []
+        worker_config.anonid_connections = dict() # Each process opens its own
+        worker_config.html_text_cache = OrderedDict()
+        worker_config.html_workers = None # Already one process per file
+        worker_config.html_pool = None
+        worker_config.pipeline_writer = None
+        worker_config.pipeline_writes = None
+        worker_config.reset_html_stats()
+        worker_config.reset_run_report()
+        worker_config.cached_outputs = OrderedDict()
+        worker_config.output_cache_keys = OrderedDict()
+        worker_config.used_cache_keys = set()
+        # Memory-mapped geoip arrays are cheaper to re-open in each worker than to pickle
+        worker_config.reload_geoip_data = worker_config.geoipv4_data is not None
+        worker_config.geoipv4_data = None
+        worker_config.geoipv4_ipvalues = None
+        return worker_config
+    
+    # Called in the worker once a file has been processed: the state that the main process needs to merge
+    def worker_results(self):
+        results = {'new_anonid_rows': self.new_anonid_rows, 'in_memory_workbooks': self.in_memory_workbooks, 'html_stats': self.html_stats,
+            'cached_outputs': self.cached_outputs, 'output_cache_keys': self.output_cache_keys, 'used_cache_keys': self.used_cache_keys,
+            'run_report_records': self.run_report_records}
+        self.new_anonid_rows = []
+        self.in_memory_workbooks = OrderedDict()
+        self.reset_html_stats()
+        self.reset_run_report()
+        self.cached_outputs = OrderedDict()
+        self.output_cache_keys = OrderedDict()
+        self.used_cache_keys = set()
+        return results
+    
+    def merge_worker_results(self, results):
+        for row in results['new_anonid_rows']:
+            if row['userid'] not in self.anonid_lookup:
+                self.anonid_lookup[row['userid']] = row['anonid']
+                self.new_anonid_rows.append(row)
+        self.in_memory_workbooks.update(results['in_memory_workbooks'])
+        for name, count in results['html_stats'].items():
+            self.html_stats[name] += count
+        self.run_report_records += results['run_report_records']
+        self.cached_outputs.update(results['cached_outputs'])
+        self.output_cache_keys.update(results['output_cache_keys'])
+        self.used_cache_keys.update(results['used_cache_keys'])
+    
+    # Phase 1 as a pipeline (self.pipeline_queue_size, without workers). Reading the xml files (in this thread), parsing them,
+    # decoding the tables and writing the workbooks run in separate threads, linked by queues that hold at most pipeline_queue_size files.
+    # Every stage takes the files in order, so the output (including the order of new anonids) is the same as a serial run.
+    # Parsing and decoding hold the GIL, as does xlsxwriter, so workbooks are written by a separate process (pipeline_writer)
+    # and at most pipeline_queue_size of them are in flight. In memory (aggregate_in_memory) the frames are kept by the write thread.
+    def process_files_in_pipeline(self, xml_files):
+        print("*** Processing xml files as a pipeline")
+        self.pipeline_error = None
+        self.pipeline_writes = collections.deque()
+        if not self.aggregate_in_memory:
+            self.pipeline_writer = self.thread_safe_process_pool(1, initializer = init_pool_worker, initargs = (self.pool_worker_config(),))
+        read_queue, parsed_queue, frames_queue = [queue.Queue(self.pipeline_queue_size) for _ in range(3)]
+        catch_errors = not self.aggregate_in_memory # As in process_one_file, a file that fails to build or write is reported and skipped
+        stages = [threading.Thread(target = self.pipeline_stage, name = 'parse', args = (self.parse_pipeline_file, read_queue, parsed_queue, False)),
+            threading.Thread(target = self.pipeline_stage, name = 'build', args = (self.build_pipeline_file, parsed_queue, frames_queue, catch_errors)),
+            threading.Thread(target = self.pipeline_stage, name = 'write', args = (self.write_pipeline_file, frames_queue, None, catch_errors))]
+        for stage in stages:
+            stage.start()
+        try:
+            for xml_file in xml_files:
+                if self.pipeline_error is not None:
+                    break
+                read_queue.put(self.read_pipeline_file(*xml_file))
+        finally:
+            read_queue.put(None)
+            for stage in stages:
+                stage.join()
+            if self.pipeline_writer is not None:
+                self.wait_for_pipeline_writes(0)
+                self.pipeline_writer.shutdown()
+                self.pipeline_writer = None
+        if self.pipeline_error is not None:
+            raise self.pipeline_error
+    
+    # Runs step on each item of in_queue until the None that ends it. After an error the stage keeps taking items, so earlier stages are not blocked
+    def pipeline_stage(self, step, in_queue, out_queue, catch_errors):
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+            if self.pipeline_error is not None:
+                continue
+            try:
+                result = step(*item)
+            except Exception as ex:
+                traceback.print_exc()
+                if not catch_errors:
+                    self.pipeline_error = ex
+                    continue
+                print(type(ex))
+                print(ex)
+                result = None
+            if result is not None and out_queue is not None:
+                out_queue.put(result)
+        if out_queue is not None:
+            out_queue.put(None)
+    
+    def read_pipeline_file(self, relative_sub_dir, xml_filename, xml_source = None):
+        with self.timed('pipeline_stage', 'read', file = os.path.normpath(xml_filename)) as record:
+            if xml_source is None:
+                with open(xml_filename, 'rb') as f:
+                    xml_source = f.read()
+            else:
+                xml_source = xml_source.read()
+            record['bytes'] = len(xml_source)
+        return [relative_sub_dir, xml_filename, xml_source]
+    
+    def parse_pipeline_file(self, relative_sub_dir, xml_filename, xml_source):
+        print("Processing", os.path.basename(xml_filename))
+        with self.timed('xml_file', os.path.basename(xml_filename), file = os.path.normpath(xml_filename), bytes = len(xml_source)):
+            return self.parse_one_file(relative_sub_dir, xml_filename, xml_source)
+    
+    def build_pipeline_file(self, output_filename, source_file, cache_key, data, nonempty_tables):
+        with self.timed('pipeline_stage', 'build_frames', file = source_file):
+            return [source_file] + self.build_file_frames(output_filename, source_file, cache_key, data, nonempty_tables)
+    
+    def write_pipeline_file(self, source_file, output_filename, cache_key, frames):
+        if self.pipeline_writer is not None:
+            self.pipeline_writes.append(self.pipeline_writer.submit(write_frames_in_pool_worker, source_file, output_filename, cache_key, frames))
+            self.wait_for_pipeline_writes(self.pipeline_queue_size)
+            return
+        with self.timed('pipeline_stage', 'write_frames', file = source_file):
+            if not self.aggregate_in_memory:
+                print("** Writing ", output_filename)
+            self.write_file_frames(output_filename, cache_key, frames)
+    
+    def wait_for_pipeline_writes(self, pending_limit):
+        while len(self.pipeline_writes) > pending_limit:
+            self.merge_worker_results(self.pipeline_writes.popleft().result())
     
     
     def extract_xml_files_in_tar(self, tar_file, extract_dir):
@@ -555,6 +2047,62 @@ class MBZ_Extractor_Config:
                 extract_count = extract_count + 1
         return extract_count
                 
+    # # Reading xml directly from the mbz archive (read_xml_from_archive)
+    # Nothing is written to the -xml directory. Each file is named as if it had been extracted there, 
+    # so output filenames and SOURCE_FILE are the same as for an expanded archive.
+    # 'stream' reads the archive sequentially (tarfile 'r|*'): one pass stops at users.xml and a second pass reads every other file.
+    # 'random' reads the member index first (tarfile 'r:*') then reads users.xml and the other files in archive order.
+    
+    def archive_xml_files(self):
+        is_users_xml = lambda tarinfo: self.archive_member_to_xml_file(tarinfo.name)[1] == os.path.join(self.expanded_archive_directory,'.','users.xml')
+        
+        # users.xml was already read (by read_archive_users); the archive is only read once more, without it
+        passes = [True, False]
+        if self.archive_users_xml is not None:
+            yield self.archive_member_to_xml_file('users.xml') + [io.BytesIO(self.archive_users_xml)]
+            passes = [False]
+            is_archive_xml_file = lambda tarinfo: self.is_archive_xml_file(tarinfo) and not is_users_xml(tarinfo)
+        else:
+            is_archive_xml_file = self.is_archive_xml_file
+        
+        if self.archive_access_mode == 'random':
+            with tarfile.open(self.archive_source_file, mode='r:*') as tf:
+                members = [tarinfo for tarinfo in tf.getmembers() if is_archive_xml_file(tarinfo)]
+                members.sort(key = lambda tarinfo: (not is_users_xml(tarinfo), tarinfo.offset))
+                for tarinfo in members:
+                    with tf.extractfile(tarinfo) as xml_source:
+                        yield self.archive_member_to_xml_file(tarinfo.name) + [xml_source]
+            return
+        
+        if self.archive_access_mode != 'stream':
+            raise ValueError("self.archive_access_mode should be 'stream' or 'random'")
+        
+        for users_pass in passes:
+            with tarfile.open(self.archive_source_file, mode='r|*') as tf:
+                for tarinfo in tf:
+                    if not is_archive_xml_file(tarinfo) or is_users_xml(tarinfo) != users_pass:
+                        continue
+                    with tf.extractfile(tarinfo) as xml_source:
+                        yield self.archive_member_to_xml_file(tarinfo.name) + [xml_source]
+                    if users_pass:
+                        break
+    
+    def is_archive_xml_file(self, tarinfo):
+        if not tarinfo.isfile() or os.path.splitext(tarinfo.name)[1] != ".xml":
+            return False
+        relative_sub_dir, xml_filename = self.archive_member_to_xml_file(tarinfo.name)
+        if self.toplevel_xml_only and relative_sub_dir != '.':
+            return False
+        return self.xml_file_selected(relative_sub_dir, xml_filename)
+    
+    # e.g. 'activities/forum_12/forum.xml' -> ['./activities/forum_12', '<expanded_archive_directory>/./activities/forum_12/forum.xml']
+    def archive_member_to_xml_file(self, member_name):
+        if member_name.startswith('./'):
+            member_name = member_name[2:]
+        parts = member_name.split('/')
+        relative_sub_dir = os.path.join('.', *parts[:-1])
+        return [relative_sub_dir, os.path.join(self.expanded_archive_directory, relative_sub_dir, parts[-1])]
+    
     def archive_file_to_output_dir(self,archive_file):
         return os.path.splitext(archive_file)[0] + '-out'
     
@@ -582,19 +2130,39 @@ class MBZ_Extractor_Config:
 
     def process_xml_files(self):
         
-        print("*** Source xml directory :", self.expanded_archive_directory)
+        if self.read_xml_from_archive:
+            print("*** Source archive :", self.archive_source_file)
+        else:
+            print("*** Source xml directory :", self.expanded_archive_directory)
         print("*** Output directory:", self.output_directory)
     
         if not os.path.isdir(self.output_directory): 
             os.makedirs(self.output_directory)
         # We need the id-> username mapping
         self.moodleuser_to_username = None
-        self.process_directory('.')
+        self.selection_cache = dict()
+        self.in_memory_workbooks = OrderedDict()
+        self.reset_html_stats()
+        self.start_incremental_run()
+        if self.read_xml_from_archive:
+            xml_files = self.archive_xml_files()
+        else:
+            xml_files = self.list_xml_files('.')
+        
+        if self.workers and self.workers > 1:
+            self.process_files_in_parallel(xml_files)
+        elif self.pipeline_queue_size:
+            self.process_files_in_pipeline(xml_files)
+        else:
+            for xml_file in xml_files:
+                self.process_listed_file(*xml_file)
+        self.close_html_pool()
+        self.report_html_stats()
         
         if self.anonid_output_filename:
             filepath = os.path.join(self.output_directory, self.anonid_output_filename)
-            print("Writing ",filepath,len(self.anonid_df.index),'rows')
-            self.anonid_df.to_csv( filepath, index = None, header=True)
+            self.save_anonid_data(filepath)
+        self.close_anonid_database()
         
         print("*** Finished processing XML")
     
@@ -602,15 +2170,16 @@ class MBZ_Extractor_Config:
     # # Phase 2 - Aggregate Excel documents
     
     
-    def list_xlsx_files_in_dir(self, xlsx_dir):
-        xlsx_files = sorted(glob.glob(os.path.join(xlsx_dir,'*.xlsx')))
+    def list_xlsx_files_in_dir(self, xlsx_dir, extension = '.xlsx'):
+        xlsx_files = sorted(glob.glob(os.path.join(xlsx_dir,'*' + extension)), key = self.natural_sort_key)
         xlsx_files = [file for file in xlsx_files if os.path.basename(file)[0] != '~' ]
         return xlsx_files
     
     # Phase 2 - Aggregate multiple xlsx that are split across multiple course sections into a single Excel file
     def create_aggregate_sections_map(self, xlsx_dir):
-        xlsx_files = self.list_xlsx_files_in_dir(xlsx_dir)
-        
+        return self.group_by_sections(self.list_xlsx_files_in_dir(xlsx_dir, self.workbook_extension(self.intermediate_format)))
+    
+    def group_by_sections(self, xlsx_files):
         sections_map = dict()
     
         for source_file in xlsx_files:
@@ -632,14 +2201,16 @@ class MBZ_Extractor_Config:
     
     # Phase 3 - Aggregate over common objects
     def create_aggregate_common_objects_map(self, xlsx_dir):
-        xlsx_files = self.list_xlsx_files_in_dir(xlsx_dir)
-        
+        return self.group_by_common_objects(self.list_xlsx_files_in_dir(xlsx_dir, self.workbook_extension(self.intermediate_format)))
+    
+    def group_by_common_objects(self, xlsx_files):
         combined_map = dict()
         # path/_activities_workshop_ALLSECTIONS_logstores.xlsx will map to key=logstores.xlsx
+        # (the ALL_ file extension is the output_format's, e.g. ALL_logstores.parquet)
         for source_file in xlsx_files:
             path = source_file.split(os.path.sep) 
             nameparts = path[-1].split('_')
-            target = nameparts[-1]
+            target = os.path.splitext(nameparts[-1])[0] + self.workbook_extension(self.output_format)
     
             if 'ALL_' == path[-1][:4]:
                 continue # Guard against restarts
@@ -652,11 +2223,9 @@ class MBZ_Extractor_Config:
         return combined_map   
     
     
-    def rebase_row(self, row,rebase_map):
-        if isinstance(row['PARENT_SHEET'] , str):     
-            return str(int(row['PARENT_ROW_INDEX']) + int(rebase_map[ row['XLSX_SOURCEFILE'] + '#' + row['PARENT_SHEET'] ]))
-        else:
-            return ''
+    # Sorts numbers in file names by value, so that filename_5_ < filename_10_
+    def natural_sort_key(self, filename):
+        return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', filename)]
     
     
     def check_no_open_Excel_documents_in_Excel(self):
@@ -669,47 +2238,206 @@ class MBZ_Extractor_Config:
             raise IOError('Excel files '+('\n'.join(open_files))+' are currently open in Excel')
         
     def aggregate_multiple_excel_files(self,source_filenames):
-        allsheets = OrderedDict()
-        rebase_map = {}
-        # !! Poor sort  - it assumes the integers are the same char length. Todo improve so that filename_5_ < filename_10_  
-        for filename in sorted(source_filenames):
+        return self.concat_workbook_sheets(self.read_aggregated_workbooks(sorted(source_filenames, key = self.natural_sort_key)))
+    
+    def read_aggregated_workbooks(self, filenames):
+        for filename in filenames:
             print('Reading and aggregating sheets in' , filename)
-            xl = pd.ExcelFile(filename)
-            for sheet in xl.sheet_names:
-                
-                df = xl.parse(sheet)
-                df['XLSX_SOURCEFILE'] = filename
-                if sheet not in allsheets.keys():
-                    allsheets[sheet] = df
-                    rebase_map[filename+'#'+sheet] = 0
-                else:
-                    row_offset =  len(allsheets[sheet]) 
-                    rebase_map[filename+'#'+sheet] = row_offset # We will need this to rebase parent values
-                    df[ df.columns[0] ] += row_offset
-                    allsheets[sheet] = allsheets[sheet].append(df, ignore_index =True, sort = False)
-            xl.close()
-            
-        # print('rebase_map',rebase_map)
-        # The row index of the parent no longer starts at zero
-        print('Rebasing parent index entries in all sheets')    
-        for sheet in xl.sheet_names:
-            df = allsheets[sheet]       
-            df['PARENT_ROW_INDEX'] = df.apply( lambda row: self.rebase_row( row,rebase_map), axis = 1)
+            sheets = self.read_workbook(filename)
+            for df in sheets.values():
+                self.compact_frame_types(df)
+            yield filename, sheets
+    
+    # Concatenates the sheets of several workbooks in a single pass and rebases PARENT_ROW_INDEX into the combined sheets
+    # workbooks yields (source_key, OrderedDict of sheetname -> DataFrame) where the first column of each DataFrame is its row index
+    def concat_workbook_sheets(self, workbooks):
+        sheet_frames = OrderedDict()
+        row_counts = dict()
+        rebase_map = dict()
+        for source_key, sheets in workbooks:
+            for sheet, df in sheets.items():
+                row_offset = row_counts.get(sheet, 0)
+                rebase_map[(source_key, sheet)] = row_offset # We will need this to rebase parent values
+                if row_offset:
+                    df.iloc[:, 0] += row_offset
+                df['XLSX_SOURCEFILE'] = source_key
+                row_counts[sheet] = row_offset + len(df)
+                if sheet not in sheet_frames:
+                    sheet_frames[sheet] = []
+                sheet_frames[sheet].append(df)
+        
+        allsheets = OrderedDict()
+        for sheet, frames in sheet_frames.items():
+            self.align_frame_types(frames)
+            df = pd.concat(frames, ignore_index = True, sort = False)
+            frames.clear()
+            self.compact_frame_types(df)
+            df['PARENT_ROW_INDEX'] = self.rebase_parent_row_index(df, rebase_map)
             df.drop('XLSX_SOURCEFILE', axis = 1, inplace = True)
+            allsheets[sheet] = df
         return allsheets
     
+    # The row index of the parent no longer starts at zero: adds the row offset of each (source file, parent sheet) to PARENT_ROW_INDEX
+    def rebase_parent_row_index(self, df, rebase_map):
+        parent_sheet = self.plain_column_values(df['PARENT_SHEET'])
+        has_parent = (parent_sheet.map(type) == str) & (parent_sheet != '')
+        
+        keys = pd.MultiIndex.from_arrays([self.plain_column_values(df['XLSX_SOURCEFILE'])[has_parent], parent_sheet[has_parent]])
+        offsets = pd.Series(list(rebase_map.values()), index = pd.MultiIndex.from_tuples(rebase_map.keys())).reindex(keys)
+        if offsets.isna().any():
+            raise KeyError('No parent sheet to rebase ' + str(list(offsets[offsets.isna()].index[:5])))
+        
+        parent_row_index = pd.to_numeric(df['PARENT_ROW_INDEX'][has_parent]).astype(np.int64).values
+        rebased = pd.Series('', index = df.index, dtype = object)
+        rebased[has_parent] = (parent_row_index + offsets.values.astype(np.int64)).astype(str)
+        return rebased
+    
+    # # Phase 2 and 3 in a single pass (aggregate_in_memory)
+    # Phase 1 keeps each file's sheets (or spills them to aggregation_spill_directory) instead of writing an xlsx file.
+    # The ALLSECTIONS and ALL_ groupings are worked out from the file names, as for the xlsx files, 
+    # and each ALL_ workbook is concatenated, rebased and written exactly once.
+    
+    def keep_in_memory_workbook(self, output_filename, frames):
+        for sheet, df in frames.items():
+            # Same layout as reading the sheet back from Excel: the row index becomes the first column
+            # and repeated column names (e.g. <attempt><attempt>1</attempt></attempt>) are renamed attempt.1 ...
+            df.insert(0, df.index.name, df.index, allow_duplicates = True)
+            df.index = pd.RangeIndex(len(df))
+            df.columns = self.dedupe_column_names(df.columns)
+            self.excel_value_types(df)
+            self.compact_frame_types(df)
+        
+        if self.aggregation_spill_directory:
+            if not os.path.isdir(self.aggregation_spill_directory):
+                os.makedirs(self.aggregation_spill_directory)
+            spill_filename = os.path.join(self.aggregation_spill_directory, os.path.basename(output_filename) + '.pkl')
+            pd.to_pickle(frames, spill_filename)
+            frames = spill_filename
+        self.in_memory_workbooks[output_filename] = frames
+    
+    # pandas re-types the values it reads back from an xlsx file: numeric looking text becomes numbers, 
+    # blank cells become NaN. Sheets that skip the round trip are given the same types, so both ways write the same cells
+    # This is a vectorized equivalent of the TextParser step inside pd.ExcelFile.parse
+    def excel_value_types(self, df):
+        for column in df.columns:
+            if df[column].dtype != object:
+                continue
+            na = df[column].isna() | df[column].isin(EXCEL_NA_VALUES)
+            values = df[column].mask(na)
+            try:
+                df[column] = pd.to_numeric(values)
+            except (ValueError, TypeError):
+                if (~na).any() and values[~na].isin(['True','TRUE','true','False','FALSE','false']).all():
+                    values = values.isin(['True','TRUE','true'])
+                    df[column] = values.astype(object).mask(na) if na.any() else values
+                else:
+                    df[column] = values
+    
+    # Smaller column types for the sheets waiting to be aggregated (self.compact_column_types). Whole numbers with blanks
+    # (float64 with NaN, as read from Excel) become nullable Int64 and text columns with repeated values 
+    # (e.g. SOURCE_FILE, PARENT_SHEET, eventname, crud) become categoricals. The writers turn them back (see plain_column_values),
+    # so the same cells are written
+    def compact_frame_types(self, df):
+        if not self.compact_column_types:
+            return
+        for i in range(len(df.columns)):
+            values = df.iloc[:, i]
+            if pd.api.types.is_float_dtype(values) and values.dtype == np.float64:
+                missing = values.isna()
+                if missing.any() and not missing.all() and (values[~missing] == np.floor(values[~missing])).all() and (values[~missing].abs() < 2**63).all():
+                    df.isetitem(i, values.astype('Int64'))
+            elif values.dtype == object and len(values) > 1:
+                if values.nunique() <= len(values) * self.category_max_fraction and pd.api.types.infer_dtype(values, skipna = True) == 'string':
+                    df.isetitem(i, values.astype('category'))
+    
+    # Column values with the types they had before compact_frame_types
+    def plain_column_values(self, values):
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            return values.astype(object)
+        if isinstance(values.dtype, pd.Int64Dtype):
+            return values.astype(np.float64)
+        return values
+    
+    # Before pd.concat: a column keeps its compact type only if it has it in every frame (with the same categories), 
+    # otherwise it goes back to its plain type so the concatenated values are the same as without compact_frame_types
+    def align_frame_types(self, frames):
+        compact = OrderedDict()
+        for df in frames:
+            for column in df.columns:
+                if isinstance(df[column].dtype, (pd.CategoricalDtype, pd.Int64Dtype)):
+                    compact[column] = True
+        for column in compact:
+            dtypes = [df[column].dtype for df in frames if column in df.columns]
+            if all(column in df.columns for df in frames) and all(isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes):
+                categories = pd.Index(np.concatenate([df[column].cat.categories.values for df in frames])).unique()
+                for df in frames:
+                    df[column] = df[column].cat.set_categories(categories)
+            elif not all(isinstance(dtype, pd.Int64Dtype) for dtype in dtypes):
+                for df in frames:
+                    if column in df.columns:
+                        df[column] = self.plain_column_values(df[column])
+    
+    def dedupe_column_names(self, columns):
+        seen = set()
+        result = []
+        for name in columns:
+            unique_name, count = name, 0
+            while unique_name in seen:
+                count += 1
+                unique_name = name + '.' + str(count)
+            seen.add(unique_name)
+            result.append(unique_name)
+        return result
+    
+    def load_in_memory_workbook(self, output_filename):
+        frames = self.in_memory_workbooks.pop(output_filename)
+        if isinstance(frames, str):
+            spill_filename = frames
+            frames = pd.read_pickle(spill_filename)
+            os.remove(spill_filename)
+        return frames
+    
+    # Returns an OrderedDict of each ALL_ workbook -> the phase 1 files that end up in it 
+    # (via the ALLSECTIONS workbooks), in aggregation order
+    def aggregation_sources(self, filenames):
+        sections_map = self.group_by_sections(filenames)
+        
+        section_targets = dict()
+        for targetfile, sources in sections_map.items():
+            for file in sources:
+                section_targets[file] = targetfile
+        
+        # The names that aggreate_over_common_objects would find after aggreate_over_sections
+        combined_map = self.group_by_common_objects(sorted(set(section_targets.get(file, file) for file in filenames), key = self.natural_sort_key))
+        
+        all_sources = OrderedDict()
+        for targetfile, targets in combined_map.items():
+            sources = []
+            for target in sorted(targets, key = self.natural_sort_key):
+                sources += sorted(sections_map[target], key = self.natural_sort_key) if target in sections_map else [target]
+            all_sources[targetfile] = sources
+        return all_sources
+    
+    def aggregate_in_memory_workbooks(self):
+        filenames = sorted(self.in_memory_workbooks.keys(), key = self.natural_sort_key)
+        for targetfile, sources in self.aggregation_sources(filenames).items():
+            print('Aggregating', len(sources), 'files into', targetfile)
+            with self.timed('aggregate', 'in_memory', file = targetfile) as record:
+                allsheets = self.concat_workbook_sheets((file, self.load_in_memory_workbook(file)) for file in sources)
+                record['rows'] = self.total_rows(allsheets)
+            self.write_sqlite_tables(targetfile, allsheets)
+            self.write_aggregated_model(targetfile, allsheets)
+    
     def write_aggregated_model(self, output_filename, allsheets):
         print("Writing",output_filename)
         if self.dry_run:
             print("Dry run. Skipping ", allsheets.keys())
             return
         
-        excelwriter = pd.ExcelWriter(output_filename, engine = excelengine)
         try:
             print("Writing Sheets ", allsheets.keys())
-            for sheetname,df in allsheets.items():
-                df.to_excel(excelwriter, sheet_name = sheetname, index = 'INDEX')
-            excelwriter.close()
+            self.write_workbook(output_filename, allsheets)
+            self.record_column_catalog(output_filename, allsheets)
             
         except Exception as ex:
             print(type(ex))
@@ -717,9 +2445,124 @@ class MBZ_Extractor_Config:
             pass
         
         finally:
-            excelwriter.close()
             print('Writing finished\n')
     
+    # # SQLite output (optional)
+    # Every ALL_ sheet also becomes a table <object>__<sheet> (e.g. forum__post) in sqlite_output_filename.
+    # INDEX is the row number within the ALL_ sheet, so a child row's parent is 
+    # SELECT * FROM forum__discussion WHERE "INDEX" = post.PARENT_ROW_INDEX (the table named by PARENT_SHEET)
+    
+    def sqlite_output_path(self):
+        return os.path.join(self.output_directory, self.sqlite_output_filename)
+    
+    # Incremental runs keep the tables of the unchanged ALL_ workbooks
+    def remove_sqlite_output(self):
+        if self.xml_cache_directory:
+            return
+        if self.sqlite_output_filename and not self.dry_run and os.path.exists(self.sqlite_output_path()):
+            os.remove(self.sqlite_output_path())
+    
+    def sqlite_table_name(self, output_filename, sheetname):
+        name = os.path.splitext(os.path.basename(output_filename))[0]
+        if name.startswith('ALL_'):
+            name = name[4:]
+        return name + '__' + sheetname
+    
+    def sqlite_quote(self, name):
+        return '"' + name.replace('"', '""') + '"'
+    
+    def sqlite_column_type(self, column_name, values):
+        if column_name in ['INDEX','PARENT_ROW_INDEX','SOURCE_LINE'] or pd.api.types.is_integer_dtype(values) or pd.api.types.is_bool_dtype(values):
+            return 'INTEGER'
+        if pd.api.types.is_float_dtype(values):
+            values = values.dropna()
+            if len(values) == 0:
+                return ''
+            # Whole numbers are read back from Excel as integers
+            return 'INTEGER' if (values == np.floor(values)).all() else 'REAL'
+        if pd.api.types.infer_dtype(values, skipna = True) in ('string', 'empty'):
+            return 'TEXT'
+        return '' # Mixed values are stored as they are
+    
+    # The xlsx 'Unnamed: 0' (or INDEX) columns are old row numbers. They are replaced by the row number in this sheet
+    def sqlite_table_frame(self, df):
+        junk = [column for column in df.columns if re.match(r'^(Unnamed: \d+|INDEX)(\.\d+)?$', str(column))]
+        df = df.drop(columns = junk)
+        for i in range(len(df.columns)):
+            df.isetitem(i, self.plain_column_values(df.iloc[:, i]))
+        df.insert(0, 'INDEX', np.arange(len(df)))
+        if 'PARENT_ROW_INDEX' in df.columns:
+            df['PARENT_ROW_INDEX'] = pd.to_numeric(df['PARENT_ROW_INDEX'].replace('', np.nan))
+        # SQLite column names are not case sensitive
+        seen = set()
+        names = []
+        for name in df.columns:
+            unique_name, count = str(name), 0
+            while unique_name.lower() in seen:
+                count += 1
+                unique_name = str(name) + '.' + str(count)
+            seen.add(unique_name.lower())
+            names.append(unique_name)
+        df.columns = names
+        return df
+    
+    def write_sqlite_tables(self, output_filename, allsheets):
+        if not self.sqlite_output_filename:
+            return
+        if self.dry_run:
+            print("Dry run. Skipping sqlite tables", allsheets.keys())
+            return
+        print("Writing sqlite tables to", self.sqlite_output_path())
+        # Autocommit mode, so the DROP and CREATE TABLE statements are also inside the explicit transaction 
+        # (sqlite3 only opens its implicit transaction at the first INSERT)
+        connection = sqlite3.connect(self.sqlite_output_path(), isolation_level = None)
+        try:
+            connection.execute('PRAGMA synchronous = OFF')
+            with self.timed('write', 'sqlite', file = output_filename, rows = self.total_rows(allsheets)):
+                connection.execute('BEGIN')
+                try:
+                    for sheetname, df in allsheets.items():
+                        self.write_sqlite_table(connection, self.sqlite_table_name(output_filename, sheetname), self.sqlite_table_frame(df))
+                    connection.execute('COMMIT')
+                except BaseException:
+                    connection.execute('ROLLBACK') # The previous tables are kept if anything fails
+                    raise
+        except Exception as ex:
+            traceback.print_exc()
+            print(type(ex))
+            print(ex)
+        finally:
+            connection.close()
+    
+    def write_sqlite_table(self, connection, table, df):
+        print("Writing table", table, len(df), "rows")
+        column_types = [self.sqlite_column_type(column, df[column]) for column in df.columns]
+        column_defs = [ (self.sqlite_quote(column) + ' ' + column_type).strip() for column, column_type in zip(df.columns, column_types)]
+        column_defs[0] = self.sqlite_quote('INDEX') + ' INTEGER PRIMARY KEY'
+        
+        connection.execute('DROP TABLE IF EXISTS ' + self.sqlite_quote(table))
+        connection.execute('CREATE TABLE ' + self.sqlite_quote(table) + ' (' + ', '.join(column_defs) + ')')
+        
+        # Python values (not numpy scalars) with None for missing values
+        columns = [ df[column].astype(object).where(df[column].notna(), None).tolist() for column in df.columns]
+        insert = 'INSERT INTO ' + self.sqlite_quote(table) + ' VALUES (' + ','.join(['?'] * len(columns)) + ')'
+        rows = zip(*columns)
+        while True:
+            batch = list(itertools.islice(rows, self.sqlite_batch_size))
+            if not batch:
+                break
+            connection.executemany(insert, batch)
+        
+        # Indexes are cheaper to build after the rows are inserted
+        indexes = []
+        if 'PARENT_SHEET' in df.columns and 'PARENT_ROW_INDEX' in df.columns:
+            indexes.append(['PARENT_SHEET', 'PARENT_ROW_INDEX'])
+        indexes += [[column] for column in df.columns if column in ['PARENT_ID', 'anonid'] or column.endswith('_utc')]
+        for index_columns in indexes:
+            index_name = table + '__' + '_'.join(index_columns)
+            connection.execute('CREATE INDEX ' + self.sqlite_quote(index_name) + ' ON ' + self.sqlite_quote(table) 
+                + ' (' + ', '.join(self.sqlite_quote(column) for column in index_columns) + ')')
+    
     def move_old_files(self, xlsx_dir, filemap, subdirname):
         xlsxpartsdir = os.path.join(xlsx_dir,subdirname)
         if self.dry_run:
@@ -734,13 +2577,17 @@ class MBZ_Extractor_Config:
     
                 dest=os.path.join(xlsxpartsdir, os.path.basename(file))
                 print(dest)
+                if os.path.isdir(dest): # Columnar workbook from an earlier run
+                    shutil.rmtree(dest)
                 os.rename(file, dest)
     
     def aggreate_over_sections(self):
         sections_map= self.create_aggregate_sections_map(self.output_directory)
     
         for targetfile,sources in sections_map.items():
-            allsheets = self.aggregate_multiple_excel_files(sources)
+            with self.timed('aggregate', 'sections', file = targetfile) as record:
+                allsheets = self.aggregate_multiple_excel_files(sources)
+                record['rows'] = self.total_rows(allsheets)
             self.write_aggregated_model(targetfile, allsheets)
     
         self.move_old_files(self.output_directory, sections_map,'_EACH_SECTION_')
@@ -749,36 +2596,112 @@ class MBZ_Extractor_Config:
         combined_map = self.create_aggregate_common_objects_map(self.output_directory)
         
         for targetfile,sources in combined_map.items():
-            allsheets = self.aggregate_multiple_excel_files(sources)
+            with self.timed('aggregate', 'common_objects', file = targetfile) as record:
+                allsheets = self.aggregate_multiple_excel_files(sources)
+                record['rows'] = self.total_rows(allsheets)
+            self.write_sqlite_tables(targetfile, allsheets)
             self.write_aggregated_model(targetfile, allsheets )
             
         self.move_old_files(self.output_directory, combined_map, '_ALL_SECTIONS_' )
     
+    # # Column catalog
+    # write_aggregated_model records the columns of each workbook as it is written (record_column_catalog), 
+    # so __All_COLUMNS.csv and __COLUMN_CATALOG.json are written without reading the workbooks back.
+    # A workbook that was not written in this run (e.g. unchanged in an incremental run) keeps its entry 
+    # from the previous catalog if it has not been modified since, otherwise its column names are read as before.
+    
+    def record_column_catalog(self, output_filename, sheets):
+        workbook_format = self.workbook_format(output_filename)
+        catalog_sheets = OrderedDict()
+        for sheet, df in sheets.items():
+            source_xml = sorted(set(df['SOURCE_FILE'].dropna().astype(str))) if 'SOURCE_FILE' in df.columns else []
+            if workbook_format == 'xlsx':
+                column_names = self.excel_header_names(['' if df.index.name is None else str(df.index.name)] + [str(column) for column in df.columns])
+                values = [df.index.to_series()] + [self.plain_column_values(df.iloc[:, i]) for i in range(len(df.columns))]
+            else:
+                frame = self.columnar_sheet_frame(df)
+                column_names = list(frame.columns)
+                values = [frame.iloc[:, i] for i in range(len(frame.columns))]
+            columns = []
+            for column_name, column in zip(column_names, values):
+                columns.append(OrderedDict([('column', column_name), ('dtype', pd.api.types.infer_dtype(column, skipna = True)), ('null_fraction', self.null_fraction(column))]))
+            catalog_sheets[sheet] = OrderedDict([('rows', len(df)), ('source_xml', source_xml), ('columns', columns)])
+        self.column_catalog[os.path.basename(output_filename)] = OrderedDict([('format', workbook_format), 
+            ('modified', os.path.getmtime(output_filename)), ('sheets', catalog_sheets)])
+    
+    # The column names that reading an xlsx sheet back gives, as pd.ExcelFile.parse names the header cells: the named columns are deduplicated first, 
+    # then an empty header cell in column i is called 'Unnamed: i' (or 'Unnamed: i.1' ... if that name is taken)
+    def excel_header_names(self, names):
+        named = iter(self.dedupe_column_names([name for name in names if name != '']))
+        result = [next(named) if name != '' else None for name in names]
+        seen = set(result)
+        for i, name in enumerate(result):
+            if name is None:
+                unique_name, count = 'Unnamed: ' + str(i), 0
+                while unique_name in seen:
+                    count += 1
+                    unique_name = 'Unnamed: ' + str(i) + '.' + str(count)
+                seen.add(unique_name)
+                result[i] = unique_name
+        return result
+    
+    # Missing values and empty text (both are empty cells in Excel)
+    def null_fraction(self, values):
+        if len(values) == 0:
+            return 0.0
+        return round(float((values.isna() | (values.astype(object) == '')).mean()), 6)
+    
+    def column_catalog_from_workbook(self, filename):
+        catalog_sheets = OrderedDict()
+        for sheet, columns in self.read_workbook_columns(filename).items():
+            catalog_sheets[sheet] = OrderedDict([('rows', None), ('source_xml', []), 
+                ('columns', [OrderedDict([('column', column_name), ('dtype', None), ('null_fraction', None)]) for column_name in columns])])
+        return OrderedDict([('format', self.workbook_format(filename)), ('modified', os.path.getmtime(filename)), ('sheets', catalog_sheets)])
+    
+    def previous_column_catalog(self, catalog_filename):
+        if not os.path.exists(catalog_filename):
+            return dict()
+        try:
+            with open(catalog_filename) as f:
+                return json.load(f, object_pairs_hook = OrderedDict)['files']
+        except Exception as ex:
+            print("Ignoring the previous column catalog", catalog_filename, ex)
+            return dict()
+    
     def create_column_metalist(self):
-        xlsx_files = self.list_xlsx_files_in_dir(self.output_directory)
+        xlsx_files = self.list_xlsx_files_in_dir(self.output_directory, self.workbook_extension(self.output_format))
+        catalog_filename = os.path.join(self.output_directory,'__COLUMN_CATALOG.json')
+        previous_catalog = self.previous_column_catalog(catalog_filename)
         
+        catalog = OrderedDict()
         metalist = []
     
         for filename in xlsx_files:
-            print(filename)
-            xl = pd.ExcelFile(filename)
             filename_local = os.path.basename(filename)
+            entry = self.column_catalog.get(filename_local)
+            if entry is None:
+                entry = previous_catalog.get(filename_local)
+                if entry is None or entry['modified'] != os.path.getmtime(filename):
+                    print(filename)
+                    entry = self.column_catalog_from_workbook(filename)
+            catalog[filename_local] = entry
     
-            for sheet in xl.sheet_names:
-    
-                df = xl.parse(sheet,nrows=1)
+            for sheet, sheet_entry in entry['sheets'].items():
+                source_xml = ';'.join(sorted(set(os.path.basename(source_file) for source_file in sheet_entry['source_xml'])))
     
-                for column_name in df.columns:
-                    metalist.append([filename_local,sheet,column_name])
-            xl.close()
+                for column in sheet_entry['columns']:
+                    metalist.append([filename_local,sheet,column['column'],sheet_entry['rows'],column['dtype'],column['null_fraction'],source_xml])
     
-        meta_df = pd.DataFrame(metalist, columns=['file','sheet','column'])
+        meta_df = pd.DataFrame(metalist, columns=['file','sheet','column','rows','dtype','null_fraction','source_xml'])
+        meta_df['rows'] = meta_df['rows'].astype('Int64')
     
         meta_filename = os.path.join(self.output_directory,'__All_COLUMNS.csv')
         if self.dry_run:
             print('Dry run. Skipping',meta_filename)
         else:
             meta_df.to_csv(meta_filename,sep='\t',index=False)
+            with open(catalog_filename, 'w') as f:
+                json.dump({'files': catalog}, f, indent = 1)
     
 
     def extract(self):     
@@ -805,39 +2728,176 @@ class MBZ_Extractor_Config:
             else:
                 raise ValueError('Please specify self.output_directory')
             
-        if self.anonid_input_filename:
-            print ('Reading' + self.anonid_input_filename + ' mapping')
-            self.anonid_df = pd.read_csv(self.anonid_input_filename)
-            
-            self.validate_anonid_data()
-        else:
-            self.anonid_df = pd.DataFrame(columns=['userid','moodleid','anonid']) # 'userid':'-1','anonid':'example1234'}])
-        
+        self.reset_run_report()
+        self.column_catalog = OrderedDict()
+        if not self.reuse_loaded_data:
+            with self.timed('phase', 'load_anonid_data'):
+                self.load_anonid_data()
         
         start_time = datetime.now()
         print(start_time)
         
-        if self.geoip_datadir :
-            self.load_geoip_data()
+        if self.geoip_datadir and not self.reuse_loaded_data:
+            with self.timed('phase', 'load_geoip_data'):
+                self.load_geoip_data()
             
-        if self.archive_source_file:
-            self.lazy_extract_mbz()
+        if self.read_xml_from_archive and not self.archive_source_file:
+            raise ValueError('self.read_xml_from_archive requires self.archive_source_file')
+        
+        if self.archive_source_file and not self.read_xml_from_archive:
+            with self.timed('phase', 'expand'):
+                self.lazy_extract_mbz()
         
         self.check_no_open_Excel_documents_in_Excel()
         # Now the actual processing can begin
         
-        self.process_xml_files() #self.expanded_archive_directory,self.output_directory, self.toplevel_xml_only, self.dry_run, self.anonid_output_filename)
-        # At this point we have 100s of Excel documents (one per xml file), each with several sheets (~ one per xml tag)!
-        # We can aggregate over all of the course sections
-        self.aggreate_over_sections() #self.output_directory)
-        
-        # Workshops, assignments etc have a similar structure, so we also aggregate over similar top-level objects
-        self.aggreate_over_common_objects()# self.output_directory)
-        self.create_column_metalist()
+        with self.timed('phase', 'process_xml_files'):
+            self.process_xml_files() #self.expanded_archive_directory,self.output_directory, self.toplevel_xml_only, self.dry_run, self.anonid_output_filename)
+        self.remove_sqlite_output()
+        self.prepare_incremental_aggregation()
+        if self.aggregate_in_memory:
+            with self.timed('phase', 'aggregate_in_memory'):
+                self.aggregate_in_memory_workbooks()
+        else:
+            # At this point we have 100s of Excel documents (one per xml file), each with several sheets (~ one per xml tag)!
+            # We can aggregate over all of the course sections
+            with self.timed('phase', 'aggregate_over_sections'):
+                self.aggreate_over_sections() #self.output_directory)
+            
+            # Workshops, assignments etc have a similar structure, so we also aggregate over similar top-level objects
+            with self.timed('phase', 'aggregate_over_common_objects'):
+                self.aggreate_over_common_objects()# self.output_directory)
+        with self.timed('phase', 'column_metalist'):
+            self.create_column_metalist()
+        self.finish_incremental_run()
         
         end_time = datetime.now()
         print(end_time)
         print(end_time-start_time)
+        self.write_run_report(start_time, end_time)
+
+    # # Batch of archives
+    # extract_batch(['course1.mbz','course2.mbz']) or extract_batch('backups/*.mbz') extracts each archive with this configuration.
+    # The geoip data and anonid mapping are loaded once. The users.xml of every archive is read first and the anonids 
+    # of all of the users are assigned here, so every course sees the same mapping (even with uuid4 anonids).
+    # With batch_workers, the archives are extracted by a pool of worker processes, one archive per task. 
+    # Each worker is replaced after batch_archives_per_worker archives (Python 3.11+), so memory does not build up over a long batch.
+    # Returns the anonid mapping of the whole batch (also written to anonid_output_filename, if given)
+    
+    def extract_batch(self, archives, anonid_output_filename = None):
+        if isinstance(archives, str):
+            archives = sorted(glob.glob(archives))
+        archives = list(archives)
+        if len(archives) == 0:
+            raise ValueError('Nothing to do: No mbz archive files')
+        for archive_file in archives:
+            if not os.path.isfile(archive_file):
+                raise ValueError(archive_file + ' does not refer to an existing archive')
+        
+        start_time = datetime.now()
+        self.load_anonid_data()
+        if self.geoip_datadir:
+            self.load_geoip_data()
+        
+        print("*** Reading the users of", len(archives), "archives")
+        users_xmls = []
+        for archive_users, users_xml in self.map_batch_archives('read_archive_users', archives):
+            for moodleid, username in archive_users:
+                self.username_to_anonid(username, moodleid)
+            users_xmls.append(users_xml)
+        self.merge_new_anonid_rows() # So the anonid file of each archive has the whole mapping
+        
+        print("*** Extracting", len(archives), "archives")
+        self.batch_results = OrderedDict()
+        for result in self.map_batch_archives('extract_batch_archive', archives, users_xmls):
+            for row in result.pop('new_anonid_rows'):
+                if row['userid'] not in self.anonid_lookup:
+                    self.anonid_lookup[row['userid']] = row['anonid']
+                    self.new_anonid_rows.append(row)
+            self.batch_results[result['archive_source_file']] = result
+            
+        failed = [archive_file for archive_file, result in self.batch_results.items() if result['error']]
+        print("***", len(archives) - len(failed), "archives extracted in", datetime.now() - start_time)
+        for archive_file in failed:
+            print("*** Failed:", archive_file, self.batch_results[archive_file]['error'])
+        
+        if anonid_output_filename:
+            self.save_anonid_data(anonid_output_filename)
+        mapping = self.anonid_mapping()
+        self.close_anonid_database()
+        return mapping
+    
+    # Yields the result of self.method_name(archive_file, ...) for each archive in order, from the batch worker pool (or this process)
+    # args are lists with one value per archive
+    def map_batch_archives(self, method_name, archives, *args):
+        if not self.batch_workers or self.batch_workers <= 1:
+            for task_args in zip(archives, *args):
+                yield getattr(self, method_name)(*task_args)
+            return
+        
+        options = {'initializer': init_pool_worker, 'initargs': (self.pool_worker_config(),)}
+        if sys.version_info >= (3, 11):
+            options['max_tasks_per_child'] = self.batch_archives_per_worker
+        with concurrent.futures.ProcessPoolExecutor(self.batch_workers, **options) as pool:
+            for result in pool.map(batch_task_in_pool_worker, itertools.repeat(method_name), archives, *args):
+                yield result
+    
+    # The configuration for one archive of the batch. The output directory is archive_file_to_output_dir(archive_file) 
+    # or, if output_directory is set, a subdirectory of it named after the archive
+    def batch_archive_config(self, archive_file):
+        config = copy.copy(self)
+        config.archive_source_file = archive_file
+        config.expanded_archive_directory = self.archive_file_to_xml_dir(archive_file)
+        if self.output_directory:
+            config.output_directory = os.path.join(self.output_directory, os.path.splitext(os.path.basename(archive_file))[0])
+        else:
+            config.output_directory = self.archive_file_to_output_dir(archive_file)
+        config.anonid_lookup = dict(self.anonid_lookup)
+        config.new_anonid_rows = []
+        config.reuse_loaded_data = True
+        return config
+    
+    # Returns [[moodle id, username] of each user in the users.xml of the archive, the content of users.xml (or None)]
+    # The archive is only decompressed up to users.xml. Its content is handed to extract_batch_archive, 
+    # so the extraction does not look for users.xml again (see archive_users_xml)
+    def read_archive_users(self, archive_file):
+        config = self.batch_archive_config(archive_file)
+        config.archive_access_mode = 'stream' # 'random' would read the whole member index first
+        data = dict()
+        users_xml = None
+        xml_files = config.archive_xml_files()
+        try:
+            relative_sub_dir, xml_filename, xml_source = next(xml_files, [None, '', None])
+            if relative_sub_dir == '.' and os.path.basename(xml_filename) == 'users.xml': # users.xml is always first
+                users_xml = xml_source.read()
+                config.table_children = dict()
+                config.process_element_stream(data, [], ['','',''], io.BytesIO(users_xml))
+        except Exception as ex:
+            traceback.print_exc()
+            print("*** Could not read the users of", archive_file, ex) # Reported again when the archive is extracted
+        finally:
+            xml_files.close()
+        
+        users = data.get('user')
+        if users is None:
+            print("*** No users.xml in", archive_file)
+            return [[], None]
+        return [[[users.get_value(row, 'id'), users.get_value(row, 'username')] for row in range(len(users)) if users.has_value(row, 'username')], users_xml]
+    
+    def extract_batch_archive(self, archive_file, users_xml = None):
+        config = self.batch_archive_config(archive_file)
+        config.archive_users_xml = users_xml
+        result = OrderedDict([('archive_source_file', archive_file), ('output_directory', config.output_directory), ('error', None)])
+        start_time = datetime.now()
+        try:
+            config.extract()
+        except Exception as ex:
+            traceback.print_exc()
+            result['error'] = repr(ex)
+        result['seconds'] = (datetime.now() - start_time).total_seconds()
+        # Users that were not in users.xml (expected to be none)
+        result['new_anonid_rows'] = config.anonid_df.iloc[len(self.anonid_df):].to_dict('records') + config.new_anonid_rows
+        return result
 
     def __init__(self) :
         self.archive_source_file = None
@@ -846,23 +2906,134 @@ class MBZ_Extractor_Config:
 
         self.skip_expanding_if_xml_files_found = True
 
+        # Parse the xml files straight out of the archive without expanding them into expanded_archive_directory
+        self.read_xml_from_archive = False
+        self.archive_access_mode = 'stream' # 'stream' (sequential passes, any tar compression) or 'random' (uses the member index)
+        self.archive_users_xml = None # The content of users.xml if it was already read from the archive (see extract_batch)
+
         # Defaults to sibling directory "-out"
         self.output_directory = None
 
         self.generate_missing_anonid = 'uuid4'  # uuid4 'salt+sha1' or NOne
 
         self.geoip_datadir = None
+        self.geoipv4_data = None # Loaded by load_geoip_data()
 
         self.anonid_input_filename = None
         # A simple csv file with header 'userid','anonid'
 
         self.anonid_output_filename='userids_anonids.csv' # None if mapping should not be written
 
+        # An SQLite file that keeps the anonids across runs and courses (see anonid_database), e.g. 'cohort_anonids.sqlite'
+        # The rows of anonid_input_filename, if given, are added to it. Several extractions may use the same file at once
+        self.anonid_database_filename = None
+        self.anonid_lookup_batch_size = 500 # Usernames per SELECT ... IN (...)
+        self.anonid_busy_timeout = 60 # Seconds to wait for another process that is adding users
+        self.anonid_connections = dict() # Thread id -> sqlite3 connection
+
         self.delete_userids = False # User table will still have an 'id' column
         #relateduserids,realuserid andu userid columns in other tables are dropped
         self.millisecond_times = True
+        # Also add a column for each key of the decoded 'other' and 'configdata' payloads (PHP serialized or JSON) e.g. other_forumid, other_mode
+        self.expand_base64_payloads = False
+
+        # Only extract part of the backup (fnmatch patterns, see name_selected). None includes everything
+        self.include_xml_files = None # Relative paths e.g. ['course/logstores.xml', 'activities/forum_*/*'] ; users.xml is always read
+        self.exclude_xml_files = []
+        self.include_tables = None # xml tags e.g. ['logstore_standard_log', 'grade_grade']
+        self.exclude_tables = [] # An excluded table is skipped with all of the tables inside it
+        self.include_columns = None # Including decoded columns e.g. ['userid', 'anonid', 'timecreated_utc']
+        self.exclude_columns = []
+        self.selection_cache = dict()
+        self.filter_while_parsing = False # Set while parsing each xml file
+
+        # Parse each xml file incrementally (lxml iterparse) rather than loading the whole tree.
+        # Same output; peak memory no longer grows with the size of large files e.g. logstores.xml
+        self.streaming_xml_parser = False
+
+        # Skip the per-file and ALLSECTIONS xlsx files: keep each file's sheets in memory and write only the final ALL_ workbooks
+        self.aggregate_in_memory = False
+        self.aggregation_spill_directory = None # If set, sheets waiting to be aggregated are pickled here rather than held in memory
+        self.compact_column_types = True # Whole numbers with blanks become Int64 and repeated text columns categoricals while aggregating
+        self.category_max_fraction = 0.5 # A text column becomes categorical if it has at most this many distinct values per row
+
+        # Storage format of the per-file and ALLSECTIONS workbooks (intermediate_format) and of the final ALL_ workbooks (output_format)
+        # 'xlsx', 'parquet' or 'feather'. The columnar formats need pyarrow and are much faster to write and read back
+        self.intermediate_format = 'xlsx'
+        self.output_format = 'xlsx'
+        self.excel_max_rows = EXCEL_MAX_ROWS # Longer tables continue in another sheet, 'sheet (2)' ...
+
+        # Also write every ALL_ sheet as a table in this SQLite database (in output_directory), e.g. 'course.sqlite'
+        # Unlike an Excel sheet, a table is not limited to 1,048,576 rows
+        self.sqlite_output_filename = None
+        self.sqlite_batch_size = 10000 # Rows per executemany
+
+        # html to text: the most recently used texts are kept (by content hash) as the same html is repeated across sections
+        self.html_text_cache = OrderedDict()
+        self.html_cache_size = 100000 # Number of texts kept in html_text_cache
+        self.html_workers = None # If set (and workers is not), html that is not in the cache is parsed by this many processes
+        self.html_batch_size = 200 # html cells per task
+        self.html_pool = None
+        self.reset_html_stats()
+
+        # Re-use the tables of unchanged xml files and keep unchanged ALL_ workbooks from the previous run (see prepare_incremental_aggregation)
+        # Not used with uuid4 anonids unless anonid_input_filename is set
+        self.incremental = False
+        self.incremental_cache_directory = None # Defaults to _CACHE_ in output_directory
+        self.xml_cache_directory = None # Set by start_incremental_run()
+        self.table_children = dict() # Set while parsing each xml file
+
+        # Number of worker processes for phase 1. users.xml is always processed first, in this process
+        self.workers = None
+        # If set (and workers is not), phase 1 reads, parses, decodes and writes the xml files in overlapping stages (see process_files_in_pipeline)
+        # The read stage holds each xml file whole in memory, so up to pipeline_queue_size + 2 of them are loaded at once
+        self.pipeline_queue_size = None # Files waiting between two stages e.g. 2
+        self.pipeline_error = None
+        self.pipeline_writer = None
+
+        # Timings of each xml file, column decoder, workbook write and aggregation (see timed); written as .json and .csv in output_directory
+        self.run_report_filename = '__RUN_REPORT' # None to skip
+        self.reset_run_report()
+        self.column_catalog = OrderedDict() # Workbook -> sheets and columns, see record_column_catalog
+
+        # Used by extract_batch
+        self.batch_workers = None # Number of archives extracted at the same time, each in its own worker process
+        self.batch_archives_per_worker = 1 # Archives extracted by a worker process before it is replaced (Python 3.11+)
+        self.reuse_loaded_data = False # extract() uses the anonid mapping and geoip data that are already loaded
 
         # Internal testing options
         self.toplevel_xml_only = False # Don't process subdirectories. Occasionally useful for internal testing
         self.dry_run = False # Don't write Excel files. Occasionally useful for internal testing
 
+
+# Process pool workers (see process_files_in_parallel). Each worker process keeps its own copy of the configuration
+pool_worker_config = None
+
+def init_pool_worker(config):
+    global pool_worker_config
+    pool_worker_config = config
+    if config.reload_geoip_data:
+        config.load_geoip_data()
+
+def process_file_in_pool_worker(relative_sub_dir, xml_filename, xml_source = None):
+    pool_worker_config.process_listed_file(relative_sub_dir, xml_filename, xml_source)
+    return pool_worker_config.worker_results()
+
+# The write stage of process_files_in_pipeline. Like process_one_file, a workbook that can not be written is reported and skipped
+def write_frames_in_pool_worker(source_file, output_filename, cache_key, frames):
+    try:
+        pool_worker_config.write_pipeline_file(source_file, output_filename, cache_key, frames)
+    except Exception as ex:
+        traceback.print_exc()
+        print(type(ex))
+        print(ex)
+    return pool_worker_config.worker_results()
+
+# extract_batch pool task (see map_batch_archives)
+def batch_task_in_pool_worker(method_name, archive_file, *args):
+    return getattr(pool_worker_config, method_name)(archive_file, *args)
+
+# html_workers pool task (see decode_html_column)
+def html_to_text_batch(htmls):
+    config = MBZ_Extractor_Config()
+    return [config.decode_html_to_text(html) for html in htmls]
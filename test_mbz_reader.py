@@ -0,0 +1,31 @@
+# Run with: python -m pytest -q
+import io
+import lxml.etree as ET
+import pytest
+from mbz_reader import *
+
+# An empty attribute followed by a leaf of the same name joins as ',5' (only $@NULL@$ keeps its text when repeated)
+REPEATED_LEAVES_XML = b'''<?xml version="1.0"?>
+<root>
+  <row id=""><id>5</id></row>
+  <row id="$@NULL@$"><id>6</id></row>
+  <row id="7"><id>$@NULL@$</id><id>8</id></row>
+  <row><name>$@NULL@$</name></row>
+</root>
+'''
+
+def parse_rows(stream):
+    o = MBZ_Extractor_Config()
+    o.table_children = dict()
+    data, tablenames = dict(), []
+    if stream:
+        o.process_element_stream(data, tablenames, ['', '', ''], io.BytesIO(REPEATED_LEAVES_XML))
+    else:
+        o.process_element(data, tablenames, ['', '', ''], ET.parse(io.BytesIO(REPEATED_LEAVES_XML)).getroot())
+    return data['row']
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_repeated_leaf_after_empty_attribute(stream):
+    rows = parse_rows(stream)
+    assert [rows.get_value(row, 'id') for row in range(3)] == [',5', '$@NULL@$,6', '7,$@NULL@$,8']
+    assert rows.get_value(3, 'name') == ''